@@ -0,0 +1,469 @@
+"""
+Benchmark de extremo a extremo del endpoint /query del servicio de caché.
+
+Levanta cache/app.py contra un Redis y un MongoDB locales (procesos redis-server
+y mongod en puertos temporales) o contra dobles en memoria (fakeredis y
+mongomock), siembra una colección traffic_events sintética y ejecuta cargas
+fijas para cada combinación de política y tamaño de caché. Registra throughput,
+percentiles de latencia, tasa de hits y operaciones hechas sobre Redis/MongoDB,
+y falla si los resultados empeoran respecto a la línea base guardada.
+
+Uso:
+    python benchmarks/cache_benchmark.py --backend fake
+    python benchmarks/cache_benchmark.py --backend local --events 50000 --save-baseline
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+CACHE_APP = REPO_ROOT / "cache" / "app.py"
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+
+WORKLOADS = ["all-hit", "all-miss", "zipf", "normal", "mixed"]
+POLICIES = ["LRU", "LFU"]
+EVENT_TYPES = ["accident", "traffic_jam", "hazard", "road_closed", "police"]
+COMUNAS = ["Santiago Centro", "Providencia", "Las Condes", "Ñuñoa", "Maipú", "La Florida", "Puente Alto"]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('cache_benchmark')
+
+
+def free_port():
+    """Obtiene un puerto TCP libre en localhost"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_until(check, timeout=30, what="servicio"):
+    """Espera hasta que check() no lance excepción ni devuelva False"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check() is not False:
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timeout esperando {what}")
+
+def event_id(i):
+    return f"waze_bench_{i}"
+
+def make_event(i, rng):
+    """Evento sintético con la misma forma que los que genera el scraper"""
+    lat = -33.45 + rng.normal(0, 0.08)
+    lon = -70.65 + rng.normal(0, 0.08)
+    event_type = EVENT_TYPES[i % len(EVENT_TYPES)]
+    comuna = COMUNAS[i % len(COMUNAS)]
+    return {
+        "uuid": event_id(i),
+        "type": event_type,
+        "location": f"{lat},{lon}",
+        "location_desc": comuna,
+        "description": f"{event_type.title()} en {comuna}",
+        "timestamp": "2025-04-21T21:00:29",
+        "source": "waze_api",
+        "waze_id": f"bench_{i}"
+    }
+
+def seed_events(collection, n_events, seed=42):
+    """Siembra la colección traffic_events con n_events eventos sintéticos"""
+    rng = np.random.default_rng(seed)
+    collection.drop()
+    batch = []
+    for i in range(n_events):
+        batch.append(make_event(i, rng))
+        if len(batch) >= 5000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    collection.create_index('uuid', unique=True)
+    logger.info(f"Sembrados {n_events} eventos sintéticos")
+
+
+def zipf_indices(rng, n_events, count, s=2):
+    """Índices según Zipf truncada a n_events (como el generador de tráfico)"""
+    result = []
+    while len(result) < count:
+        idx = rng.zipf(s, size=count) - 1
+        result.extend(idx[idx < n_events].tolist())
+    return result[:count]
+
+def normal_indices(rng, n_events, count):
+    """Índices según una normal centrada en la mitad de la colección"""
+    result = []
+    scale = max(1, n_events // 6)
+    while len(result) < count:
+        idx = rng.normal(loc=n_events // 2, scale=scale, size=count).astype(int)
+        result.extend(idx[(idx >= 0) & (idx < n_events)].tolist())
+    return result[:count]
+
+def build_workload(name, n_events, n_requests, cache_size, seed=7):
+    """
+    Devuelve (calentamiento, secuencia) de IDs para una carga.
+    El calentamiento se consulta antes de medir y no cuenta en los resultados.
+    """
+    rng = np.random.default_rng(seed)
+    if name == "all-hit":
+        # Conjunto caliente que cabe holgadamente en la caché
+        hot = list(range(max(1, min(cache_size // 2, n_events))))
+        return [event_id(i) for i in hot], [event_id(i) for i in rng.choice(hot, size=n_requests)]
+    if name == "all-miss":
+        # Cada ID se consulta una sola vez
+        count = min(n_requests, n_events)
+        if count < n_requests:
+            logger.warning(f"all-miss limitado a {count} consultas (una por evento sembrado)")
+        return [], [event_id(i) for i in rng.permutation(n_events)[:count]]
+    if name == "zipf":
+        return [], [event_id(i) for i in zipf_indices(rng, n_events, n_requests)]
+    if name == "normal":
+        return [], [event_id(i) for i in normal_indices(rng, n_events, n_requests)]
+    if name == "mixed":
+        half = n_requests // 2
+        ids = zipf_indices(rng, n_events, half) + normal_indices(rng, n_events, n_requests - half)
+        rng.shuffle(ids)
+        return [], [event_id(i) for i in ids]
+    raise ValueError(f"Carga desconocida: {name}")
+
+
+def run_requests(base_url, ids, concurrency, distribution="benchmark", accept_encoding="gzip, deflate",
+                 conditional=False):
+    """
+    Envía las consultas con `concurrency` clientes y devuelve latencias, fuentes y bytes
+    recibidos (cuerpo tal como viaja, comprimido o no). Con conditional=True cada cliente
+    reenvía el último ETag recibido para cada id en If-None-Match.
+    """
+    chunks = [ids[i::concurrency] for i in range(concurrency)]
+
+    def client(chunk):
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = accept_encoding
+        latencies, sources, wire_bytes = [], Counter(), 0
+        etags = {}
+        for eid in chunk:
+            headers = {"If-None-Match": etags[eid]} if conditional and eid in etags else {}
+            start = time.perf_counter()
+            response = session.get(f"{base_url}/query", params={"id": eid, "distribution": distribution},
+                                   headers=headers)
+            latencies.append(time.perf_counter() - start)
+            wire_bytes += int(response.headers.get("Content-Length", len(response.content)))
+            if response.status_code == 200:
+                sources[response.json().get("source", "unknown")] += 1
+                if "ETag" in response.headers:
+                    etags[eid] = response.headers["ETag"]
+            elif response.status_code == 304:
+                sources["not_modified"] += 1
+            else:
+                sources[f"http_{response.status_code}"] += 1
+        return latencies, sources, wire_bytes
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client, chunks))
+    wall = time.perf_counter() - start
+
+    latencies = [l for r in results for l in r[0]]
+    sources = sum((r[1] for r in results), Counter())
+    return latencies, sources, wall, sum(r[2] for r in results)
+
+
+class CountingProxy:
+    """Envuelve un cliente y cuenta las llamadas a cada método"""
+
+    def __init__(self, target):
+        self._target = target
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+class FakeBackend:
+    """cache/app.py en el mismo proceso, con fakeredis y mongomock"""
+
+    def __init__(self, n_events):
+        import fakeredis
+        import mongomock
+        from werkzeug.serving import make_server
+
+        spec = importlib.util.spec_from_file_location("cache_app", CACHE_APP)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+        logging.getLogger("cache_app").setLevel(logging.WARNING)
+
+        collection = mongomock.MongoClient()['traffic_db']['traffic_events']
+        seed_events(collection, n_events)
+        server = fakeredis.FakeServer()
+        self.redis = CountingProxy(fakeredis.FakeRedis(server=server))
+        self.mongo = CountingProxy(collection)
+        self.module.redis_client = self.redis
+        self.module.query_cache = fakeredis.FakeRedis(server=server, db=self.module.QUERY_CACHE_DB)
+        self.module.collection = self.mongo
+
+        port = free_port()
+        self.server = make_server("127.0.0.1", port, self.module.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    def configure(self, cache_size):
+        self.module.MAX_CACHE_SIZE = cache_size
+
+    def redis_ops(self):
+        return dict(self.redis.calls)
+
+    def mongo_ops(self):
+        return dict(self.mongo.calls)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class LocalBackend:
+    """cache/app.py como proceso, contra redis-server y mongod locales"""
+
+    def __init__(self, n_events):
+        import pymongo
+        import redis
+
+        for binary in ["redis-server", "mongod"]:
+            if not shutil.which(binary):
+                raise RuntimeError(f"No se encontró {binary} en el PATH (use --backend fake)")
+
+        self.tmpdir = tempfile.mkdtemp(prefix="cache_bench_")
+        self.redis_port, self.mongo_port = free_port(), free_port()
+        self.processes = [
+            subprocess.Popen(["redis-server", "--port", str(self.redis_port), "--save", "", "--appendonly", "no"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+            subprocess.Popen(["mongod", "--port", str(self.mongo_port), "--bind_ip", "127.0.0.1",
+                              "--dbpath", self.tmpdir], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+        ]
+        self.redis = redis.Redis(port=self.redis_port)
+        self.mongo_client = pymongo.MongoClient(port=self.mongo_port, serverSelectionTimeoutMS=1000)
+        wait_until(self.redis.ping, what="redis-server")
+        wait_until(lambda: self.mongo_client.admin.command('ping'), what="mongod")
+        seed_events(self.mongo_client['traffic_db']['traffic_events'], n_events)
+
+        self.app_process = None
+        self.app_port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.app_port}"
+
+    def configure(self, cache_size):
+        """Reinicia cache/app.py con el tamaño de caché indicado"""
+        self.stop_app()
+        env = dict(os.environ,
+                   REDIS_HOST="127.0.0.1", REDIS_PORT=str(self.redis_port),
+                   MONGO_URI=f"mongodb://127.0.0.1:{self.mongo_port}/",
+                   CACHE_PORT=str(self.app_port), CACHE_MAX_SIZE=str(cache_size))
+        self.app_process = subprocess.Popen([sys.executable, str(CACHE_APP)], env=env,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_until(lambda: requests.get(f"{self.base_url}/health").ok, what="cache/app.py")
+
+    def redis_ops(self):
+        return {name.replace("cmdstat_", ""): info["calls"]
+                for name, info in self.redis.info("commandstats").items()}
+
+    def mongo_ops(self):
+        return dict(self.mongo_client.admin.command("serverStatus")["opcounters"])
+
+    def stop_app(self):
+        if self.app_process:
+            self.app_process.terminate()
+            self.app_process.wait()
+            self.app_process = None
+
+    def close(self):
+        self.stop_app()
+        for process in self.processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def diff_counts(after, before):
+    """Diferencia entre dos conteos de operaciones, omitiendo las que no cambiaron"""
+    return {k: after[k] - before.get(k, 0) for k in after if after[k] - before.get(k, 0)}
+
+def run_case(backend, workload, policy, cache_size, args):
+    """Ejecuta una carga con una política y tamaño de caché y devuelve sus métricas"""
+    response = requests.post(f"{backend.base_url}/clear")
+    if response.status_code != 200:
+        raise RuntimeError(f"/clear respondió {response.status_code}: {response.text}")
+    response = requests.post(f"{backend.base_url}/policy", json={"policy": policy})
+    if response.status_code != 200:
+        raise RuntimeError(f"/policy respondió {response.status_code}: {response.text}")
+
+    warmup, ids = build_workload(workload, args.events, args.requests, cache_size)
+    if warmup:
+        run_requests(backend.base_url, warmup, args.concurrency)
+
+    redis_before, mongo_before = backend.redis_ops(), backend.mongo_ops()
+    latencies, sources, wall, wire_bytes = run_requests(backend.base_url, ids, args.concurrency,
+                                                        accept_encoding=args.accept_encoding,
+                                                        conditional=args.conditional)
+    redis_ops = diff_counts(backend.redis_ops(), redis_before)
+    mongo_ops = diff_counts(backend.mongo_ops(), mongo_before)
+
+    latencies_ms = np.array(latencies) * 1000
+    answered = sources.get("cache", 0) + sources.get("database", 0)
+    not_modified = sources.get("not_modified", 0)
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / wall if wall > 0 else 0,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "hit_rate": sources.get("cache", 0) / answered if answered else 0,
+        "not_modified": not_modified,
+        "bytes_per_request": wire_bytes / len(latencies) if latencies else 0,
+        "errors": len(latencies) - answered - not_modified,
+        "redis_ops": redis_ops,
+        "mongo_ops": mongo_ops,
+    }
+
+def measure_log_cost(n_requests=20000):
+    """
+    Costo del log por solicitud de /query en el hilo que la atiende, en µs: líneas
+    INFO síncronas con f-strings (como antes de common/logsetup.py), en cola sin
+    muestreo y en cola con el LOG_SAMPLE_RATE configurado. Se escribe a /dev/null.
+    """
+    sys.path.insert(0, str(REPO_ROOT / "common"))
+    import logsetup
+
+    results = {}
+    logger = logging.getLogger("log_cost")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    with open(os.devnull, "w") as devnull:
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logsetup.TextFormatter(logsetup.TEXT_FORMAT))
+
+        logger.handlers = [handler]
+        start = time.perf_counter()
+        for i in range(n_requests):
+            logger.info(f"Consulta por ID: {event_id(i)}")
+            logger.info(f"Cache HIT para ID: {event_id(i)}")
+        results["sync"] = (time.perf_counter() - start) / n_requests * 1e6
+
+        log_queue = queue.Queue()
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        logger.handlers = [logsetup.DroppingQueueHandler(log_queue, handler)]
+        configured_rate = logsetup.LOG_SAMPLE_RATE
+        for rate in (1.0, configured_rate):
+            logsetup.LOG_SAMPLE_RATE = rate
+            start = time.perf_counter()
+            for i in range(n_requests):
+                logsetup.log_request(logger, "Cache HIT", event_id=event_id(i))
+            results[f"queue/sample={rate:g}"] = (time.perf_counter() - start) / n_requests * 1e6
+        logsetup.LOG_SAMPLE_RATE = configured_rate
+        listener.stop()
+    return results
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Devuelve la lista de regresiones respecto a la línea base"""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {result['throughput']:.1f} < {base['throughput']:.1f} req/s")
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p99 {result['p99_ms']:.2f} > {base['p99_ms']:.2f} ms")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del endpoint /query del servicio de caché")
+    parser.add_argument("--backend", choices=["fake", "local"], default="fake",
+                        help="fake: fakeredis/mongomock en proceso; local: redis-server y mongod")
+    parser.add_argument("--events", type=int, default=10000, help="Eventos sintéticos a sembrar")
+    parser.add_argument("--requests", type=int, default=2000, help="Consultas por carga")
+    parser.add_argument("--concurrency", type=int, default=8, help="Clientes concurrentes")
+    parser.add_argument("--policies", nargs="+", default=POLICIES, choices=POLICIES)
+    parser.add_argument("--cache-sizes", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--workloads", nargs="+", default=WORKLOADS, choices=WORKLOADS)
+    parser.add_argument("--accept-encoding", default="gzip, deflate",
+                        help='Accept-Encoding de los clientes ("identity" para medir sin compresión)')
+    parser.add_argument("--conditional", action="store_true",
+                        help="Reenviar el ETag recibido en If-None-Match (respuestas 304)")
+    parser.add_argument("--log-cost", action="store_true",
+                        help="Medir además el costo del log por solicitud (síncrono, en cola, muestreado)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Guarda los resultados como nueva línea base")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Regresión relativa permitida (0.2 = 20%%)")
+    parser.add_argument("--output", type=Path, help="Archivo JSON donde guardar los resultados")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    backend = FakeBackend(args.events) if args.backend == "fake" else LocalBackend(args.events)
+
+    results = {}
+    try:
+        for cache_size in args.cache_sizes:
+            backend.configure(cache_size)
+            for policy in args.policies:
+                for workload in args.workloads:
+                    key = f"{args.backend}/{policy}/{cache_size}/{workload}"
+                    result = run_case(backend, workload, policy, cache_size, args)
+                    results[key] = result
+                    logger.info(f"{key}: {result['throughput']:.1f} req/s, "
+                                f"p50/p95/p99 {result['p50_ms']:.2f}/{result['p95_ms']:.2f}/{result['p99_ms']:.2f} ms, "
+                                f"hit rate {result['hit_rate'] * 100:.1f}%, "
+                                f"{result['bytes_per_request']:.0f} B/req, {result['not_modified']} 304, "
+                                f"redis {sum(result['redis_ops'].values())} ops, "
+                                f"mongo {sum(result['mongo_ops'].values())} ops")
+    finally:
+        backend.close()
+
+    if args.log_cost:
+        for mode, cost in measure_log_cost().items():
+            logger.info(f"Log por solicitud ({mode}): {cost:.2f} µs")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.save_baseline:
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+        logger.info(f"Línea base guardada en {args.baseline}")
+        return 0
+
+    if not baseline:
+        logger.warning(f"No hay línea base en {args.baseline}; ejecute con --save-baseline para crearla")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        logger.error(f"Regresión: {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Benchmark offline del scraper contra la API de Waze simulada (waze_stub_server.py).
+
+Para cada factor de escala levanta el servidor simulado con las respuestas grabadas
+(o sintéticas), carga scraper/scraper.py apuntando a él y mide:
+  - process_waze_data: eventos procesados por segundo sobre la respuesta completa del área
+  - barrido completo: tiempo del primer barrido (aprende la subdivisión) y de los
+    siguientes, con las solicitudes hechas y los eventos obtenidos
+Falla si los resultados empeoran respecto a la línea base guardada.
+
+Uso:
+    python benchmarks/scraper_benchmark.py --scales 1 10 100 --latency-ms 100
+    python benchmarks/scraper_benchmark.py --recordings /data/recordings --save-baseline
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from waze_stub_server import build_server  # noqa: E402
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SCRAPER = REPO_ROOT / "scraper" / "scraper.py"
+BASELINE_FILE = Path(__file__).resolve().parent / "scraper_baseline.json"
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('scraper_benchmark')
+
+
+def load_scraper(api_url, tiling_file, concurrency):
+    """Carga scraper/scraper.py como módulo, configurado para el servidor simulado y sin límite de tasa"""
+    os.environ.update(WAZE_API_URL=api_url, TILING_FILE=tiling_file, SCRAPER_MAX_RPS="0",
+                      SCRAPER_CONCURRENCY=str(concurrency), RECORD_DIR="")
+    spec = importlib.util.spec_from_file_location("scraper_under_test", SCRAPER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logging.getLogger("scraper").setLevel(logging.WARNING)
+    return module
+
+def measure_processing(scraper, server, min_seconds):
+    """Eventos por segundo de process_waze_data sobre la respuesta completa del área"""
+    quadrant = scraper.cell_for_path("")
+    data = server.query(quadrant["min_lat"], quadrant["min_lon"], quadrant["max_lat"], quadrant["max_lon"], sys.maxsize)
+    events = rounds = 0
+    start = time.perf_counter()
+    while rounds == 0 or time.perf_counter() - start < min_seconds:
+        events += len(scraper.process_waze_data(data, quadrant))
+        rounds += 1
+    return events / (time.perf_counter() - start)
+
+def measure_sweeps(scraper, server, sweeps):
+    """Tiempo, solicitudes y eventos del primer barrido y del promedio de los siguientes"""
+    tiling = scraper.load_tiling()
+    results = []
+    for _ in range(sweeps):
+        requests_before = server.requests
+        start = time.perf_counter()
+        events = scraper.sweep_tiling(tiling)[0]
+        results.append((time.perf_counter() - start, server.requests - requests_before, len(events)))
+    steady = results[1:] or results
+    return {
+        "first_sweep_s": results[0][0],
+        "sweep_s": sum(r[0] for r in steady) / len(steady),
+        "requests": steady[-1][1],
+        "events": steady[-1][2],
+        "cells": len(tiling),
+    }
+
+def run_case(scale, args):
+    server = build_server(args.recordings, scale, args.latency_ms, args.jitter_ms).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="scraper_bench_") as tmpdir:
+            scraper = load_scraper(server.api_url, os.path.join(tmpdir, "tiling.json"), args.concurrency)
+            result = {"source_events": len(server.alerts) + len(server.jams)}
+            result["process_events_per_s"] = measure_processing(scraper, server, args.min_seconds)
+            result.update(measure_sweeps(scraper, server, args.sweeps))
+            return result
+    finally:
+        server.close()
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Devuelve la lista de regresiones respecto a la línea base"""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result["process_events_per_s"] < base["process_events_per_s"] * (1 - tolerance):
+            regressions.append(f"{key}: process_waze_data {result['process_events_per_s']:.0f} < "
+                               f"{base['process_events_per_s']:.0f} eventos/s")
+        if result["sweep_s"] > base["sweep_s"] * (1 + tolerance):
+            regressions.append(f"{key}: barrido {result['sweep_s']:.2f} > {base['sweep_s']:.2f} s")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del scraper contra la API de Waze simulada")
+    parser.add_argument("--recordings", type=Path, help="Directorio con respuestas grabadas (RECORD_DIR del scraper)")
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10, 100])
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Latencia media del servidor simulado")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, default=4, help="SCRAPER_CONCURRENCY del scraper")
+    parser.add_argument("--sweeps", type=int, default=3, help="Barridos por escala (el primero aprende la subdivisión)")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Duración mínima de la medición de process_waze_data")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Guarda los resultados como nueva línea base")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Regresión relativa permitida (0.2 = 20%%)")
+    parser.add_argument("--output", type=Path, help="Archivo JSON donde guardar los resultados")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    for scale in args.scales:
+        key = f"x{scale}/{args.latency_ms:g}ms/c{args.concurrency}"
+        result = run_case(scale, args)
+        results[key] = result
+        logger.info(f"{key}: {result['source_events']} eventos en origen, "
+                    f"process_waze_data {result['process_events_per_s']:.0f} eventos/s, "
+                    f"primer barrido {result['first_sweep_s']:.2f}s, barrido {result['sweep_s']:.2f}s "
+                    f"({result['requests']} solicitudes, {result['cells']} celdas, {result['events']} eventos)")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.save_baseline:
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+        logger.info(f"Línea base guardada en {args.baseline}")
+        return 0
+
+    if not baseline:
+        logger.warning(f"No hay línea base en {args.baseline}; ejecute con --save-baseline para crearla")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        logger.error(f"Regresión: {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
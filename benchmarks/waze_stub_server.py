@@ -0,0 +1,209 @@
+"""
+Servidor HTTP local que reemplaza a la API de Waze LiveMap para benchmarks del scraper.
+
+Sirve /live-map/api/georss con los parámetros bottom/left/top/right/ma de la API real:
+devuelve las alertas y congestiones cuyo punto cae en el rectángulo, truncadas a `ma`
+resultados como hace Waze. Los datos salen de respuestas grabadas con el modo de
+grabación del scraper (RECORD_DIR) o, si no hay, de un conjunto sintético alrededor
+de Santiago, y se pueden escalar (x10, x100) replicando cada evento con un pequeño
+desplazamiento. La latencia de cada respuesta es configurable.
+
+Uso:
+    python benchmarks/waze_stub_server.py --recordings /data/recordings --scale 10 --latency-ms 150
+    WAZE_API_URL=http://127.0.0.1:8765/live-map/api/georss python scraper/scraper.py
+"""
+import argparse
+import copy
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+API_PATH = "/live-map/api/georss"
+ALERT_TYPES = ["ACCIDENT", "JAM", "HAZARD", "ROAD_CLOSED", "POLICE"]
+STREETS = ["Av. Providencia", "Alameda", "Av. Apoquindo", "Av. Vicuña Mackenna", "Av. Pajaritos", "Gran Avenida"]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('waze_stub_server')
+
+
+def item_id(item):
+    return item.get("uuid") or item.get("id") or item.get("jamId")
+
+def load_recordings(directory):
+    """Junta las alertas y congestiones de las respuestas grabadas, sin repetir ids"""
+    alerts, jams = {}, {}
+    for path in sorted(Path(directory).glob("waze_*.json")):
+        response = json.loads(path.read_text(encoding="utf-8")).get("response") or {}
+        for alert in response.get("alerts") or []:
+            alerts[item_id(alert) or len(alerts)] = alert
+        for jam in response.get("jams") or []:
+            jams[item_id(jam) or len(jams)] = jam
+    return list(alerts.values()), list(jams.values())
+
+def synthesize(n_alerts, n_jams, seed=42):
+    """Alertas y congestiones sintéticas con la forma de la API, concentradas en el centro de Santiago"""
+    rng = np.random.default_rng(seed)
+    alerts = []
+    for i in range(n_alerts):
+        lat, lon = -33.45 + rng.normal(0, 0.08), -70.65 + rng.normal(0, 0.08)
+        alerts.append({
+            "uuid": f"stub-alert-{i}",
+            "type": ALERT_TYPES[i % len(ALERT_TYPES)],
+            "location": {"x": lon, "y": lat},
+            "street": STREETS[i % len(STREETS)],
+            "reportDescription": "" if i % 3 else f"Reporte {i}",
+        })
+    jams = []
+    for i in range(n_jams):
+        lat, lon = -33.45 + rng.normal(0, 0.08), -70.65 + rng.normal(0, 0.08)
+        jams.append({
+            "uuid": f"stub-jam-{i}",
+            "line": [{"x": lon, "y": lat}, {"x": lon + 0.002, "y": lat + 0.001}],
+            "street": STREETS[i % len(STREETS)],
+            "speed": float(rng.uniform(0, 10)),
+            "length": int(rng.integers(100, 3000)),
+            "level": int(rng.integers(1, 5)),
+            "delay": int(rng.integers(0, 600)),
+        })
+    return alerts, jams
+
+def point_of(item):
+    """Coordenadas (lat, lon) de una alerta o del primer punto de una congestión"""
+    point = item.get("location") or (item.get("line") or [{}])[0]
+    return point.get("y", np.nan), point.get("x", np.nan)
+
+def move(item, dlat, dlon):
+    """Copia desplazada de una alerta o congestión"""
+    item = copy.deepcopy(item)
+    points = [item["location"]] if "location" in item else item.get("line") or []
+    for point in points:
+        point["y"] = point.get("y", 0) + dlat
+        point["x"] = point.get("x", 0) + dlon
+    return item
+
+def scale(items, factor, seed=7):
+    """Replica cada evento `factor` veces con ids nuevos y un desplazamiento de ~1 km"""
+    if factor <= 1:
+        return items
+    rng = np.random.default_rng(seed)
+    scaled = list(items)
+    for copy_index in range(1, factor):
+        offsets = rng.normal(0, 0.01, size=(len(items), 2))
+        for item, (dlat, dlon) in zip(items, offsets):
+            replica = move(item, dlat, dlon)
+            for key in ("uuid", "id", "jamId"):
+                if key in replica:
+                    replica[key] = f"{replica[key]}-x{copy_index}"
+            scaled.append(replica)
+    return scaled
+
+
+class WazeStubServer:
+    """API de Waze simulada en un hilo, con búsqueda por rectángulo vectorizada"""
+
+    def __init__(self, alerts, jams, latency_ms=0.0, jitter_ms=0.0, host="127.0.0.1", port=0):
+        self.alerts, self.jams = alerts, jams
+        self.alert_points = np.array([point_of(a) for a in alerts], dtype=float).reshape(-1, 2)
+        self.jam_points = np.array([point_of(j) for j in jams], dtype=float).reshape(-1, 2)
+        self.latency_ms, self.jitter_ms = latency_ms, jitter_ms
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{API_PATH}"
+
+    def query(self, bottom, left, top, right, limit):
+        """Respuesta de la API para un rectángulo, con a lo sumo `limit` alertas y `limit` congestiones"""
+        def inside(points):
+            lats, lons = points[:, 0], points[:, 1]
+            return np.flatnonzero((lats >= bottom) & (lats < top) & (lons >= left) & (lons < right))[:limit]
+        return {
+            "alerts": [self.alerts[i] for i in inside(self.alert_points)],
+            "jams": [self.jams[i] for i in inside(self.jam_points)],
+        }
+
+    def delay(self):
+        if self.latency_ms or self.jitter_ms:
+            time.sleep(max(0.0, np.random.normal(self.latency_ms, self.jitter_ms)) / 1000)
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != API_PATH:
+                    self.send_error(404)
+                    return
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                try:
+                    body = stub.query(float(params["bottom"]), float(params["left"]),
+                                      float(params["top"]), float(params["right"]),
+                                      int(params.get("ma", 200)))
+                except (KeyError, ValueError):
+                    self.send_error(400)
+                    return
+                with stub.lock:
+                    stub.requests += 1
+                stub.delay()
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def build_server(recordings=None, scale_factor=1, latency_ms=0.0, jitter_ms=0.0, port=0):
+    """Crea el servidor con las respuestas grabadas (o sintéticas) escaladas"""
+    alerts, jams = load_recordings(recordings) if recordings else ([], [])
+    if not alerts and not jams:
+        alerts, jams = synthesize(300, 150)
+    return WazeStubServer(scale(alerts, scale_factor), scale(jams, scale_factor),
+                          latency_ms=latency_ms, jitter_ms=jitter_ms, port=port)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="API de Waze LiveMap simulada para benchmarks del scraper")
+    parser.add_argument("--recordings", type=Path, help="Directorio con respuestas grabadas (RECORD_DIR del scraper)")
+    parser.add_argument("--scale", type=int, default=1, help="Factor de escala de alertas y congestiones")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latencia media por respuesta")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Desviación estándar de la latencia")
+    parser.add_argument("--port", type=int, default=8765)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = build_server(args.recordings, args.scale, args.latency_ms, args.jitter_ms, args.port)
+    logger.info(f"Sirviendo {len(server.alerts)} alertas y {len(server.jams)} congestiones en {server.api_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,44 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import redis
+import gzip
+import zlib
+import hashlib
 import pymongo
 import os
 import json
 import logging
 import time
+import math
+import sys
+import datetime
 import traceback
 from bson import ObjectId
 import random
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
 
 app = Flask(__name__)
 
-# Configurar logging con más detalles
-logging.basicConfig(level=logging.INFO, 
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging compartido (common/logsetup.py, copiado junto a app.py en la imagen)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from logsetup import setup_logging, log_request
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Configuración de conexiones (sobrescribible para correr fuera de docker-compose)
+REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://mongodb:27017/")
+CACHE_PORT = int(os.environ.get("CACHE_PORT", "5000"))
+
 # Conexiones a Redis y MongoDB
 try:
-    redis_client = redis.Redis(host='redis', port=6379, db=0)
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
     logger.info("Conexión a Redis inicializada")
     
-    mongo_client = pymongo.MongoClient('mongodb://mongodb:27017/')
+    mongo_client = pymongo.MongoClient(MONGO_URI)
     db = mongo_client['traffic_db']
     collection = db['traffic_events']
     logger.info("Conexión a MongoDB inicializada")
@@ -43,7 +60,7 @@ cache_ttl = 300
 CACHE_TTL = 600  
 
 # Tamaño máximo de la caché
-MAX_CACHE_SIZE = 1000 
+MAX_CACHE_SIZE = int(os.environ.get("CACHE_MAX_SIZE", "1000"))
 
 # Para LFU: contador de hits por clave
 cache_hits_counter = {}
@@ -51,6 +68,85 @@ cache_hits_counter = {}
 # Para LRU: timestamp del último uso
 cache_usage_time = {}
 
+# Canal por el que el loader publica los uuids de eventos actualizados
+EVENTS_CHANNEL = "events:changed"
+# Hits mínimos para que una clave actualizada se refresque en lugar de eliminarse
+CACHE_REFRESH_MIN_HITS = int(os.environ.get("CACHE_REFRESH_MIN_HITS", "2"))
+
+# Respuestas de eventos: tamaño mínimo para comprimir con gzip/deflate y nivel de compresión
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "5"))
+
+# Canal por el que el loader publica las celdas y comunas con eventos nuevos o modificados
+AREAS_CHANNEL = "events:areas"
+# Base de Redis separada para resultados de consultas por área (no cuenta en MAX_CACHE_SIZE)
+QUERY_CACHE_DB = int(os.environ.get("QUERY_CACHE_DB", "1"))
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", "60"))
+# Las ventanas de tiempo se alinean a este intervalo para compartir resultados en caché
+QUERY_BUCKET_SECONDS = 60
+# Tamaño en grados de las celdas de invalidación (debe coincidir con storage/data_loader.py)
+QUERY_TILE_DEG = 0.02
+# Máximo de celdas que registra una consulta; áreas mayores dependen solo de la clave "all"
+QUERY_MAX_TILES = int(os.environ.get("QUERY_MAX_TILES", "64"))
+# Lado máximo en grados de un bbox (la Región Metropolitana mide ~1,5°)
+QUERY_MAX_BBOX_DEG = 5
+# Resolución a la que se redondea el centro de las consultas por cercanía (~500 m)
+QUERY_POINT_DEG = 0.005
+QUERY_MAX_LIMIT = 500
+# Ventana por defecto (minutos desde que el scraper vio el evento por última vez, campo
+# last_seen); 0 = sin ventana, los eventos activos son los no marcados con expired_at
+QUERY_DEFAULT_MINUTES = int(os.environ.get("QUERY_DEFAULT_MINUTES", "60"))
+QUERY_MAX_RADIUS_M = 10000
+
+# Claves calientes: contadores del sketch Space-Saving (memoria fija) y vida media del decaimiento
+HOT_KEYS_CAPACITY = int(os.environ.get("HOT_KEYS_CAPACITY", "200"))
+HOT_KEYS_HALF_LIFE = float(os.environ.get("HOT_KEYS_HALF_LIFE", "60"))
+HOT_KEYS_TOP = 10
+# Claves más calientes fijadas en caché (nunca desalojadas, refrescadas antes de vencer); 0 = desactivado
+HOT_PIN_COUNT = int(os.environ.get("HOT_PIN_COUNT", "20"))
+PIN_REFRESH_INTERVAL = 15
+# Se refrescan las claves fijadas a las que les queda menos de este TTL
+PIN_REFRESH_AHEAD = 60
+
+# Instantánea del conjunto caliente en MongoDB, para precargar la caché al iniciar o tras un reinicio de Redis
+HOT_SET_COLLECTION = "cache_hot_set"
+WARMUP_SNAPSHOT_INTERVAL = int(os.environ.get("WARMUP_SNAPSHOT_INTERVAL", "60"))
+WARMUP_BATCH_SIZE = 200
+# Documentos por segundo como máximo durante la precarga, para no saturar MongoDB
+WARMUP_MAX_RATE = float(os.environ.get("WARMUP_MAX_RATE", "2000"))
+# Precargar también después de /clear (desactivado: los benchmarks usan /clear para partir en frío)
+WARMUP_ON_CLEAR = os.environ.get("WARMUP_ON_CLEAR", "false").lower() in ("1", "true", "yes")
+# Ventana de medición de la tasa de hits; se considera recuperada al llegar a esta fracción de la previa
+STEADY_WINDOW_SECONDS = 10
+STEADY_FRACTION = 0.95
+# Estado de la última precarga, expuesto en /stats
+warmup_state = {"status": "idle"}
+
+# Trazas por solicitud: las que tardan al menos SLOW_REQUEST_MS se guardan en un buffer circular
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "50"))
+SLOW_LOG_SIZE = int(os.environ.get("SLOW_LOG_SIZE", "100"))
+# Perfilador estadístico: duración máxima e intervalo de muestreo por defecto
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL_MS = 5
+# Si se define, los endpoints /admin exigen este valor en la cabecera X-Admin-Token
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+slow_requests = deque(maxlen=SLOW_LOG_SIZE)
+# Hilos que están atendiendo una solicitud (los que muestrea el perfilador)
+request_threads = set()
+profile_lock = threading.Lock()
+
+# Sketch Space-Saving: id -> [conteo, error, hits, misses], con decaimiento exponencial
+hot_keys = {}
+hot_keys_lock = threading.Lock()
+hot_keys_decayed_at = time.time()
+# Claves de caché ("event:<id>") fijadas actualmente
+pinned_keys = set()
+
+try:
+    query_cache = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=QUERY_CACHE_DB)
+except Exception as e:
+    logger.error(f"Error inicializando la caché de consultas: {str(e)}")
+
 def get_random_ttl(min_ttl=300, max_ttl=900):
     """
     Genera un TTL aleatorio entre el mínimo y máximo especificados.
@@ -175,15 +271,16 @@ def query_event():
     if event_id:
         # Clave consistente para eventos por UUID
         cache_key = f"event:{event_id}"
-        logger.info(f"Consulta por ID: {event_id}")
         
         # Verificar cache primero
-        cached_result = redis_client.get(cache_key)
+        with timed("redis"):
+            cached_result = redis_client.get(cache_key)
         
         if cached_result:
             # Cache hit - actualizar estadísticas y registros para LRU/LFU
             update_stats("hit", distribution_type)
-            logger.info(f"Cache HIT para ID: {event_id}")
+            track_hot_key(event_id, hit=True)
+            log_request(logger, "Cache HIT", event_id=event_id)
             
             current_time = time.time()
             cache_usage_time[cache_key] = current_time  # Para LRU
@@ -192,41 +289,48 @@ def query_event():
                 cache_hits_counter[cache_key] = 0
             cache_hits_counter[cache_key] += 1  # Para LFU
             
-            return jsonify({"events": json.loads(cached_result), "source": "cache"})
+            return events_response(cached_result, "cache")
         
         # Cache miss
         update_stats("miss", distribution_type)
-        logger.info(f"Cache MISS para ID: {event_id}")
+        track_hot_key(event_id, hit=False)
+        log_request(logger, "Cache MISS", event_id=event_id)
         
         # Buscar en MongoDB
         try:
             # Buscar por UUID (como los genera el scraper)
-            event = collection.find_one({"uuid": event_id})
+            with timed("mongo"):
+                event = collection.find_one({"uuid": event_id})
             
             if not event and event_id.startswith("waze_"):
                 # Búsqueda alternativa si el ID es de formato Waze
                 base_id = event_id[5:]  
-                event = collection.find_one({"waze_id": base_id})
+                with timed("mongo"):
+                    event = collection.find_one({"waze_id": base_id})
             
             if event:
-                # Convertir ObjectId a string
-                if "_id" in event and isinstance(event["_id"], ObjectId):
-                    event["_id"] = str(event["_id"])
+                # Convertir ObjectId a string y serializar una sola vez para la caché y la respuesta
+                with timed("json"):
+                    payload = serialize_event(event)
                 
                 # Guardar en caché con TTL adecuado
                 try:
                     # Si se excede el tamaño máximo, aplicar política de remoción
-                    if redis_client.dbsize() >= MAX_CACHE_SIZE:
-                        logger.info(f"Caché llena ({redis_client.dbsize()}/{MAX_CACHE_SIZE}), aplicando política {cache_policy}")
-                        evict_from_cache()
+                    with timed("redis"):
+                        cache_size = redis_client.dbsize()
+                    if cache_size >= MAX_CACHE_SIZE:
+                        log_request(logger, "Caché llena", size=cache_size, max_size=MAX_CACHE_SIZE, policy=cache_policy)
+                        with timed("evict"):
+                            evict_from_cache()
                     
                     random_ttl = get_random_ttl() 
-                    result = redis_client.setex(cache_key, random_ttl, json.dumps(event))
-                    logger.info(f"Guardado en cache: {cache_key}, TTL: {random_ttl}s, resultado: {result}")
+                    with timed("redis"):
+                        result = redis_client.setex(cache_key, random_ttl, payload)
+                    log_request(logger, "Guardado en cache", key=cache_key, ttl=random_ttl, result=result)
                 except Exception as e:
                     logger.error(f"Error guardando en cache: {e}")
                 
-                return jsonify({"events": event, "source": "database"})
+                return events_response(payload, "database")
             else:
                 logger.warning(f"Evento no encontrado: {event_id}")
                 return jsonify({"error": "Event not found"}), 404
@@ -234,6 +338,77 @@ def query_event():
             logger.error(f"Error buscando evento: {e}")
             return jsonify({"error": str(e)}), 500
 
+@app.route('/events')
+def query_events():
+    """
+    Eventos activos filtrados por comuna, tipo y/o área (bbox=min_lat,min_lon,max_lat,max_lon),
+    vistos en los últimos `minutes` minutos (0 = sin ventana). Los resultados se guardan en
+    caché por consulta normalizada.
+    """
+    try:
+        comuna = request.args.get('comuna') or None
+        event_type = request.args.get('type') or None
+        minutes, limit = parse_window_and_limit()
+        bbox = request.args.get('bbox')
+        if bbox:
+            min_lat, min_lon, max_lat, max_lon = (float(v) for v in bbox.split(','))
+            if not (-90 <= min_lat < max_lat <= 90 and -180 <= min_lon < max_lon <= 180):
+                raise ValueError("bbox fuera de rango o invertido")
+            if max_lat - min_lat > QUERY_MAX_BBOX_DEG or max_lon - min_lon > QUERY_MAX_BBOX_DEG:
+                raise ValueError(f"bbox mayor que {QUERY_MAX_BBOX_DEG}°")
+            # Ampliar el área a celdas completas para que vistas parecidas compartan resultados
+            min_lat, min_lon = snap_down(min_lat, QUERY_TILE_DEG), snap_down(min_lon, QUERY_TILE_DEG)
+            max_lat, max_lon = snap_up(max_lat, QUERY_TILE_DEG), snap_up(max_lon, QUERY_TILE_DEG)
+    except ValueError as e:
+        return jsonify({"error": f"Parámetros inválidos: {e}"}), 400
+
+    bucket, since = time_bucket(minutes)
+    mongo_filter = active_filter(since, event_type)
+    if comuna:
+        mongo_filter["location_desc"] = comuna
+    if bbox:
+        polygon = [[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]
+        mongo_filter["geo"] = {"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [polygon]}}}
+        dependencies = area_dependencies(min_lat, min_lon, max_lat, max_lon)
+        area = f"{min_lat:.3f},{min_lon:.3f},{max_lat:.3f},{max_lon:.3f}"
+    else:
+        dependencies = [f"comuna:{comuna}"] if comuna else ["all"]
+        area = "-"
+
+    cache_key = f"query:events:{comuna or '-'}|{event_type or '-'}|{area}|{minutes}|{limit}|{bucket}"
+    return run_cached_query(cache_key, dependencies,
+                            lambda: list(collection.find(mongo_filter).sort("timestamp", pymongo.DESCENDING).limit(limit)))
+
+@app.route('/events/near')
+def query_events_near():
+    """Eventos activos a menos de `radius_m` metros de (lat, lon), ordenados por distancia"""
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius = float(request.args.get('radius_m', 2000))
+        event_type = request.args.get('type') or None
+        minutes, limit = parse_window_and_limit()
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180) or not (0 < radius <= QUERY_MAX_RADIUS_M):
+            raise ValueError("coordenadas o radio fuera de rango")
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"Parámetros inválidos: {e}"}), 400
+
+    # Normalizar: centro a una grilla de ~500 m y radio a múltiplos de 250 m
+    lat = round(round(lat / QUERY_POINT_DEG) * QUERY_POINT_DEG, 6)
+    lon = round(round(lon / QUERY_POINT_DEG) * QUERY_POINT_DEG, 6)
+    radius = int(math.ceil(radius / 250) * 250)
+
+    bucket, since = time_bucket(minutes)
+    mongo_filter = active_filter(since, event_type)
+    mongo_filter["geo"] = {"$nearSphere": {"$geometry": {"type": "Point", "coordinates": [lon, lat]},
+                                           "$maxDistance": radius}}
+    dlat = radius / 111320
+    dlon = radius / (111320 * max(math.cos(math.radians(lat)), 0.01))
+    dependencies = area_dependencies(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+
+    cache_key = f"query:near:{lat}|{lon}|{radius}|{event_type or '-'}|{minutes}|{limit}|{bucket}"
+    return run_cached_query(cache_key, dependencies, lambda: list(collection.find(mongo_filter).limit(limit)))
+
 @app.route('/stats', methods=['GET'])
 def get_stats():
     """Endpoint para obtener estadísticas de caché"""
@@ -269,7 +444,10 @@ def get_stats():
             "cache_size": redis_client.dbsize(),
             "redis_info": redis_info,
             "status": "Service running",
-            "current_distribution": current_distribution
+            "current_distribution": current_distribution,
+            "hot_keys": top_hot_keys(HOT_KEYS_TOP),
+            "pinned_keys": len(pinned_keys),
+            "warmup": dict(warmup_state)
         }
         
         return jsonify(stats)
@@ -294,12 +472,86 @@ def set_policy():
 @app.route('/clear', methods=['POST'])
 def clear_cache():
     """Endpoint para limpiar la caché"""
+    warm = WARMUP_ON_CLEAR or request.args.get('warm') == '1'
+    if warm:
+        total_queries = cache_stats["hits"] + cache_stats["misses"]
+        save_hot_set(cache_stats["hits"] / total_queries if total_queries else None)
     redis_client.flushdb()
     cache_usage_time.clear()
     cache_hits_counter.clear()
+    try:
+        query_cache.flushdb()
+    except Exception as e:
+        logger.error(f"Error limpiando la caché de consultas: {e}")
     logger.info("Cache cleared")
+    if warm:
+        threading.Thread(target=warm_up_cache, args=("clear",), daemon=True).start()
     return jsonify({"message": "Cache cleared successfully"})
 
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    g.stage_timings = {}
+    request_threads.add(threading.get_ident())
+
+@app.after_request
+def add_server_timing(response):
+    """Agrega la cabecera Server-Timing y guarda la solicitud si fue lenta"""
+    total_ms = (time.perf_counter() - g.request_start) * 1000
+    stages = {stage: round(seconds * 1000, 3) for stage, seconds in g.stage_timings.items()}
+    response.headers['Server-Timing'] = ", ".join(
+        [f"{stage};dur={ms}" for stage, ms in stages.items()] + [f"total;dur={total_ms:.3f}"])
+    if total_ms >= SLOW_REQUEST_MS and not request.path.startswith('/admin/'):
+        slow_requests.append({
+            "path": request.path,
+            "query": request.query_string.decode('utf-8', 'replace'),
+            "status": response.status_code,
+            "at": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "duration_ms": round(total_ms, 3),
+            "stages": stages,
+        })
+    return response
+
+@app.teardown_request
+def end_request_timing(error=None):
+    request_threads.discard(threading.get_ident())
+
+@app.route('/admin/slow-requests', methods=['GET'])
+def get_slow_requests():
+    """Solicitudes más lentas entre las últimas SLOW_LOG_SIZE que superaron SLOW_REQUEST_MS"""
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    entries = sorted(list(slow_requests), key=lambda entry: entry["duration_ms"], reverse=True)
+    return jsonify({"threshold_ms": SLOW_REQUEST_MS, "count": len(entries), "requests": entries})
+
+@app.route('/admin/profile', methods=['GET'])
+def profile():
+    """
+    Muestrea las pilas de los hilos que atienden solicitudes durante `seconds` segundos
+    (all=1 para todos los hilos) y devuelve el formato colapsado de flamegraph.pl/speedscope:
+    una línea "marco;marco;...;marco conteo" por pila distinta.
+    """
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = float(request.args.get('interval_ms', PROFILE_INTERVAL_MS))
+    except ValueError:
+        return jsonify({"error": "seconds e interval_ms deben ser numéricos"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < 1:
+        return jsonify({"error": f"seconds debe estar entre 0 y {PROFILE_MAX_SECONDS}, interval_ms >= 1"}), 400
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"error": "Ya hay un perfilado en curso"}), 409
+    try:
+        stacks, samples = sample_stacks(seconds, interval_ms / 1000, request.args.get('all') == '1')
+    finally:
+        profile_lock.release()
+    logger.info(f"Perfilado de {seconds}s: {samples} muestras, {len(stacks)} pilas distintas")
+    body = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    response = app.response_class(body, mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    return response
+
 
 # Agregar esta función para validar el ID del evento
 def valid_event_id(event_id):
@@ -335,24 +587,465 @@ def update_stats(result_type, distribution_type="unknown"):
     elif result_type == "miss":
         cache_stats["misses"] += 1
 
+def decay_hot_keys(now):
+    """Aplica el decaimiento exponencial a todos los contadores (se llama con el lock tomado)"""
+    global hot_keys_decayed_at
+    elapsed = now - hot_keys_decayed_at
+    if elapsed < 1:
+        return
+    factor = 0.5 ** (elapsed / HOT_KEYS_HALF_LIFE)
+    for counter in hot_keys.values():
+        for i in range(4):
+            counter[i] *= factor
+    hot_keys_decayed_at = now
+
+def track_hot_key(event_id, hit):
+    """
+    Registra una consulta en el sketch Space-Saving de claves calientes.
+    Con el sketch lleno, una clave nueva reemplaza a la de menor conteo y hereda
+    ese conteo como cota de error, así que las claves frecuentes nunca se pierden.
+    """
+    with hot_keys_lock:
+        decay_hot_keys(time.time())
+        counter = hot_keys.get(event_id)
+        if counter is None:
+            if len(hot_keys) >= HOT_KEYS_CAPACITY:
+                min_id = min(hot_keys, key=lambda k: hot_keys[k][0])
+                min_count = hot_keys.pop(min_id)[0]
+                counter = [min_count, min_count, 0.0, 0.0]
+            else:
+                counter = [0.0, 0.0, 0.0, 0.0]
+            hot_keys[event_id] = counter
+        counter[0] += 1
+        counter[2 if hit else 3] += 1
+
+def top_hot_keys(n):
+    """
+    Las n claves más consultadas con su tasa estimada (consultas/s), cota de error y tasa de hits.
+    Con vida media H, un conteo estable c corresponde a una tasa de c * ln(2) / H.
+    """
+    with hot_keys_lock:
+        decay_hot_keys(time.time())
+        top = sorted(hot_keys.items(), key=lambda item: item[1][0], reverse=True)[:n]
+    to_rate = math.log(2) / HOT_KEYS_HALF_LIFE
+    return [{
+        "id": event_id,
+        "rate": round(count * to_rate, 3),
+        "error": round(error * to_rate, 3),
+        "hit_ratio": round(hits / (hits + misses), 3) if hits + misses else 0,
+        "pinned": f"event:{event_id}" in pinned_keys,
+    } for event_id, (count, error, hits, misses) in top]
+
+def refresh_pinned_keys():
+    """
+    Fija las HOT_PIN_COUNT claves más calientes y refresca desde MongoDB, en lote,
+    las que faltan en caché o están por vencer.
+    """
+    global pinned_keys
+    hot_ids = [entry["id"] for entry in top_hot_keys(HOT_PIN_COUNT)]
+    pinned_keys = {f"event:{event_id}" for event_id in hot_ids}
+    if not hot_ids:
+        return 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    for event_id in hot_ids:
+        pipe.ttl(f"event:{event_id}")
+    # TTL -2: la clave no existe; -1: sin vencimiento
+    stale = [event_id for event_id, ttl in zip(hot_ids, pipe.execute()) if ttl == -2 or 0 <= ttl < PIN_REFRESH_AHEAD]
+    if not stale:
+        return 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    refreshed = 0
+    for event in collection.find({"uuid": {"$in": stale}}):
+        pipe.setex(f"event:{event['uuid']}", get_random_ttl(), serialize_event(event))
+        refreshed += 1
+    pipe.execute()
+    return refreshed
+
+def pin_hot_keys():
+    """Recalcula y refresca periódicamente las claves fijadas"""
+    while True:
+        time.sleep(PIN_REFRESH_INTERVAL)
+        try:
+            refreshed = refresh_pinned_keys()
+            if refreshed:
+                logger.info(f"Claves fijadas refrescadas: {refreshed} de {len(pinned_keys)}")
+        except Exception as e:
+            logger.error(f"Error refrescando claves fijadas: {e}")
+
+def build_hot_set():
+    """
+    Conjunto caliente actual: ids ordenados por el mejor de sus rangos de frecuencia
+    (sketch de claves calientes) y de recencia (último hit), hasta MAX_CACHE_SIZE.
+    """
+    with hot_keys_lock:
+        by_frequency = sorted(hot_keys, key=lambda k: hot_keys[k][0], reverse=True)
+    by_recency = [key[len("event:"):] for key, _ in
+                  sorted(list(cache_usage_time.items()), key=lambda x: x[1], reverse=True)]
+    frequency_rank = {event_id: rank for rank, event_id in enumerate(by_frequency)}
+    recency_rank = {event_id: rank for rank, event_id in enumerate(by_recency)}
+    ids = sorted(set(by_frequency) | set(by_recency),
+                 key=lambda i: min(frequency_rank.get(i, math.inf), recency_rank.get(i, math.inf)))
+    return [{"id": event_id, "frequency_rank": frequency_rank.get(event_id), "recency_rank": recency_rank.get(event_id)}
+            for event_id in ids[:MAX_CACHE_SIZE]]
+
+def save_hot_set(hit_rate):
+    """Guarda la instantánea del conjunto caliente (no reemplaza una buena por una vacía)"""
+    entries = build_hot_set()
+    if not entries:
+        return 0
+    db[HOT_SET_COLLECTION].replace_one({"_id": "hot_set"}, {
+        "_id": "hot_set",
+        "keys": entries,
+        "hit_rate": hit_rate,
+        "saved_at": datetime.datetime.utcnow(),
+    }, upsert=True)
+    return len(entries)
+
+def warm_up_cache(reason):
+    """
+    Precarga la caché con la instantánea del conjunto caliente: lecturas $in de
+    WARMUP_BATCH_SIZE ids y SETEX en pipeline, a no más de WARMUP_MAX_RATE documentos/s.
+    Las claves más calientes quedan como las más recientes para LRU.
+    """
+    snapshot = db[HOT_SET_COLLECTION].find_one({"_id": "hot_set"})
+    if not snapshot or not snapshot.get("keys"):
+        logger.info("Sin instantánea del conjunto caliente, la caché parte en frío")
+        return 0
+
+    ids = [entry["id"] for entry in snapshot["keys"]][:MAX_CACHE_SIZE]
+    rank = {event_id: position for position, event_id in enumerate(ids)}
+    start = time.time()
+    warmup_state.clear()
+    warmup_state.update(status="running", reason=reason, keys=len(ids), loaded=0,
+                        target_hit_rate=snapshot.get("hit_rate"), started_at=start,
+                        duration_s=None, steady_after_s=None)
+    for offset in range(0, len(ids), WARMUP_BATCH_SIZE):
+        batch = ids[offset:offset + WARMUP_BATCH_SIZE]
+        pipe = redis_client.pipeline(transaction=False)
+        for event in collection.find({"uuid": {"$in": batch}}):
+            cache_key = f"event:{event['uuid']}"
+            pipe.setex(cache_key, get_random_ttl(), serialize_event(event))
+            cache_usage_time.setdefault(cache_key, start - rank[event["uuid"]] * 0.001)
+            cache_hits_counter.setdefault(cache_key, 0)
+        warmup_state["loaded"] += len(pipe.execute())
+        # Limitar la tasa de lectura
+        ahead = (offset + len(batch)) / WARMUP_MAX_RATE - (time.time() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    warmup_state.update(status="done", duration_s=round(time.time() - start, 2))
+    logger.info(f"Caché precargada ({reason}): {warmup_state['loaded']} de {len(ids)} claves "
+                f"en {warmup_state['duration_s']}s")
+    return warmup_state["loaded"]
+
+def redis_run_id():
+    """Identificador de la ejecución de Redis; cambia si Redis se reinicia"""
+    return redis_client.info("server").get("run_id")
+
+def maintain_hot_set():
+    """
+    Precarga la caché al iniciar y luego, cada STEADY_WINDOW_SECONDS: mide la tasa de
+    hits de la ventana para reportar cuánto tardó en recuperarse tras la precarga,
+    vuelve a precargar si Redis se reinició y guarda la instantánea cada WARMUP_SNAPSHOT_INTERVAL.
+    """
+    try:
+        warm_up_cache("inicio")
+    except Exception as e:
+        logger.error(f"Error en la precarga de la caché: {e}")
+    last_run_id = None
+    next_snapshot = time.time() + WARMUP_SNAPSHOT_INTERVAL
+    window_start = snapshot_start = (cache_stats["hits"], cache_stats["misses"])
+    while True:
+        time.sleep(STEADY_WINDOW_SECONDS)
+        try:
+            hits, misses = cache_stats["hits"], cache_stats["misses"]
+            window_hits, window_total = hits - window_start[0], hits + misses - sum(window_start)
+            window_start = (hits, misses)
+            target = warmup_state.get("target_hit_rate")
+            if (warmup_state.get("status") in ("running", "done") and warmup_state.get("steady_after_s") is None
+                    and target is not None and window_total >= 20
+                    and window_hits / window_total >= target * STEADY_FRACTION):
+                warmup_state["steady_after_s"] = round(time.time() - warmup_state["started_at"], 1)
+                logger.info(f"Tasa de hits recuperada ({window_hits / window_total:.1%}) "
+                            f"{warmup_state['steady_after_s']}s después de la precarga")
+
+            run_id = redis_run_id()
+            if last_run_id and run_id != last_run_id:
+                logger.warning("Redis se reinició, precargando la caché")
+                cache_usage_time.clear()
+                cache_hits_counter.clear()
+                warm_up_cache("reinicio de Redis")
+            last_run_id = run_id
+
+            if time.time() >= next_snapshot:
+                snapshot_hits = hits - snapshot_start[0]
+                snapshot_total = hits + misses - sum(snapshot_start)
+                snapshot_start = (hits, misses)
+                # Sin consultas desde la última instantánea no hay nada nuevo que guardar
+                if snapshot_total:
+                    save_hot_set(snapshot_hits / snapshot_total)
+                next_snapshot = time.time() + WARMUP_SNAPSHOT_INTERVAL
+        except Exception as e:
+            logger.error(f"Error manteniendo el conjunto caliente: {e}")
+
+def admin_authorized():
+    return not ADMIN_TOKEN or request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@contextmanager
+def timed(stage):
+    """Suma la duración del bloque a la etapa `stage` de la solicitud en curso (Server-Timing)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.stage_timings[stage] = g.stage_timings.get(stage, 0.0) + time.perf_counter() - start
+
+def collapse_frame(frame):
+    """Pila de un hilo de la raíz a la hoja, como "archivo.py:función;..." """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def sample_stacks(seconds, interval, all_threads=False):
+    """
+    Perfilador estadístico: cada `interval` segundos toma las pilas de los hilos con
+    sys._current_frames() y cuenta cuántas veces aparece cada una. Sólo lee los marcos,
+    así que los hilos muestreados no se detienen ni se instrumentan.
+    """
+    stacks = Counter()
+    samples = 0
+    own_thread = threading.get_ident()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        targets = None if all_threads else set(request_threads)
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread or (targets is not None and thread_id not in targets):
+                continue
+            stacks[collapse_frame(frame)] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def serialize_event(event):
+    """Serializa un evento de MongoDB para guardarlo en caché"""
+    if "_id" in event and isinstance(event["_id"], ObjectId):
+        event["_id"] = str(event["_id"])
+    # default=str para fechas BSON como updated_at
+    return json.dumps(event, default=str, separators=(',', ':'))
+
+def events_response(payload, source):
+    """
+    Respuesta {"events": ..., "source": ...} armada alrededor del JSON guardado, sin deserializarlo.
+    El ETag (débil, porque "source" varía) se deriva del contenido: si coincide con
+    If-None-Match se responde 304 sin cuerpo. Los cuerpos de COMPRESS_MIN_BYTES o más se
+    comprimen con gzip o deflate según Accept-Encoding.
+    """
+    with timed("encode"):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        etag = hashlib.blake2b(payload, digest_size=12).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        body = b'{"events":' + payload + b',"source":"' + source.encode('utf-8') + b'"}'
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag, weak=True)
+        response.vary.add('Accept-Encoding')
+        if len(body) >= COMPRESS_MIN_BYTES:
+            encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+            if encoding == 'gzip':
+                response.set_data(gzip.compress(body, compresslevel=COMPRESS_LEVEL))
+            elif encoding == 'deflate':
+                response.set_data(zlib.compress(body, COMPRESS_LEVEL))
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        return response
+
+def parse_window_and_limit():
+    """Ventana en minutos (por defecto QUERY_DEFAULT_MINUTES, 0 = sin ventana) y límite de resultados de una consulta por área"""
+    minutes = int(request.args.get('minutes', QUERY_DEFAULT_MINUTES))
+    limit = min(int(request.args.get('limit', 100)), QUERY_MAX_LIMIT)
+    if minutes < 0 or limit <= 0:
+        raise ValueError("minutes no puede ser negativo y limit debe ser positivo")
+    return minutes, limit
+
+def time_bucket(minutes):
+    """
+    Intervalo actual y el inicio de la ventana en UTC (como last_seen), alineado al intervalo
+    para compartir caché. Sin ventana el inicio es None.
+    """
+    bucket = int(time.time() // QUERY_BUCKET_SECONDS)
+    if not minutes:
+        return bucket, None
+    return bucket, datetime.datetime.utcfromtimestamp(bucket * QUERY_BUCKET_SECONDS - minutes * 60)
+
+def active_filter(since, event_type=None):
+    """
+    Filtro de eventos vigentes: no marcados como desaparecidos y, si hay ventana, vistos
+    por el scraper desde `since`. Se usa last_seen y no timestamp porque los eventos
+    re-emitidos sin cambios no se reescriben y su timestamp queda en el último cambio.
+    """
+    mongo_filter = {"expired_at": {"$exists": False}}
+    if since is not None:
+        mongo_filter["last_seen"] = {"$gte": since}
+    if event_type:
+        mongo_filter["type"] = event_type
+    return mongo_filter
+
+def snap_down(value, step):
+    return round(math.floor(value / step) * step, 6)
+
+def snap_up(value, step):
+    return round(math.ceil(value / step) * step, 6)
+
+def tile_of(lat, lon):
+    """Celda de invalidación de una coordenada"""
+    return f"{math.floor(lat / QUERY_TILE_DEG)}:{math.floor(lon / QUERY_TILE_DEG)}"
+
+def tiles_in_box(min_lat, min_lon, max_lat, max_lon):
+    """Celdas de invalidación que cubren un rectángulo"""
+    rows = range(math.floor(min_lat / QUERY_TILE_DEG), math.floor(max_lat / QUERY_TILE_DEG) + 1)
+    cols = range(math.floor(min_lon / QUERY_TILE_DEG), math.floor(max_lon / QUERY_TILE_DEG) + 1)
+    return [f"{row}:{col}" for row in rows for col in cols]
+
+def area_dependencies(min_lat, min_lon, max_lat, max_lon):
+    """
+    Dependencias de invalidación de un rectángulo: sus celdas, o solo "all" si cubre más de
+    QUERY_MAX_TILES (se invalida con cualquier cambio, sin registrar miles de conjuntos)
+    """
+    rows = math.floor(max_lat / QUERY_TILE_DEG) - math.floor(min_lat / QUERY_TILE_DEG) + 1
+    cols = math.floor(max_lon / QUERY_TILE_DEG) - math.floor(min_lon / QUERY_TILE_DEG) + 1
+    if rows * cols > QUERY_MAX_TILES:
+        return ["all"]
+    return [f"tile:{t}" for t in tiles_in_box(min_lat, min_lon, max_lat, max_lon)]
+
+def run_cached_query(cache_key, dependencies, run_query):
+    """
+    Responde una consulta por área desde la caché de consultas o, si no está, desde MongoDB.
+    El resultado se guarda con QUERY_CACHE_TTL y su clave se registra en un conjunto por
+    cada celda o comuna de la que depende, para invalidarla cuando cambian sus eventos.
+    """
+    try:
+        with timed("redis"):
+            cached = query_cache.get(cache_key)
+        if cached:
+            return events_response(cached, "cache")
+    except Exception as e:
+        logger.error(f"Error leyendo la caché de consultas: {e}")
+
+    try:
+        with timed("mongo"):
+            events = run_query()
+    except Exception as e:
+        logger.error(f"Error en consulta por área: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    with timed("json"):
+        payload = "[" + ",".join(serialize_event(event) for event in events) + "]"
+    try:
+        with timed("redis"):
+            pipe = query_cache.pipeline(transaction=False)
+            pipe.setex(cache_key, QUERY_CACHE_TTL, payload)
+            for dependency in dependencies:
+                pipe.sadd(f"query:dep:{dependency}", cache_key)
+                # Los conjuntos también expiran, para no acumular claves ya vencidas
+                pipe.expire(f"query:dep:{dependency}", QUERY_CACHE_TTL * 2)
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Error guardando consulta en caché: {e}")
+    return events_response(payload, "database")
+
+def invalidate_areas(tiles, comunas):
+    """Elimina las consultas en caché que dependen de las celdas o comunas indicadas"""
+    dependencies = [f"query:dep:tile:{t}" for t in tiles] + [f"query:dep:comuna:{c}" for c in comunas]
+    dependencies.append("query:dep:all")
+    pipe = query_cache.pipeline(transaction=False)
+    for dependency in dependencies:
+        pipe.smembers(dependency)
+    keys = set().union(*pipe.execute())
+    query_cache.delete(*keys, *dependencies)
+    return len(keys)
+
+def apply_event_changes(uuids):
+    """
+    Invalida o refresca las claves de eventos actualizados en MongoDB.
+    Las claves calientes (con al menos CACHE_REFRESH_MIN_HITS hits) se reescriben
+    conservando su TTL; las demás se eliminan. Todo se envía en pipelines.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for uuid in uuids:
+        pipe.exists(f"event:{uuid}")
+    cached = [uuid for uuid, exists in zip(uuids, pipe.execute()) if exists]
+    if not cached:
+        return 0, 0
+
+    hot = [uuid for uuid in cached if cache_hits_counter.get(f"event:{uuid}", 0) >= CACHE_REFRESH_MIN_HITS]
+    refreshed = set()
+    pipe = redis_client.pipeline(transaction=False)
+    if hot:
+        for event in collection.find({"uuid": {"$in": hot}}):
+            # xx: solo si la clave sigue en caché; keepttl: no extender su vida
+            pipe.set(f"event:{event['uuid']}", serialize_event(event), xx=True, keepttl=True)
+            refreshed.add(event["uuid"])
+
+    dropped = [uuid for uuid in cached if uuid not in refreshed]
+    for uuid in dropped:
+        cache_key = f"event:{uuid}"
+        pipe.delete(cache_key)
+        cache_usage_time.pop(cache_key, None)
+        cache_hits_counter.pop(cache_key, None)
+    pipe.execute()
+    return len(refreshed), len(dropped)
+
+def listen_for_event_changes():
+    """Aplica en lotes los cambios de eventos publicados por el loader"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(EVENTS_CHANNEL, AREAS_CHANNEL)
+            for message in pubsub.listen():
+                if message["channel"].decode() == AREAS_CHANNEL:
+                    areas = json.loads(message["data"])
+                    invalidated = invalidate_areas(areas.get("tiles", []), areas.get("comunas", []))
+                    if invalidated:
+                        logger.info(f"Consultas por área invalidadas: {invalidated}")
+                    continue
+                refreshed, dropped = apply_event_changes(json.loads(message["data"]))
+                if refreshed or dropped:
+                    logger.info(f"Eventos actualizados: {refreshed} refrescados, {dropped} invalidados en caché")
+        except Exception as e:
+            logger.error(f"Error procesando eventos actualizados: {e}")
+            time.sleep(5)
+
 def evict_from_cache():
     """Elimina elementos según la política de caché configurada"""
     try:
         if cache_policy == "LRU":
-            # Encuentra la clave menos recientemente usada
-            if cache_usage_time:
-                oldest_key = min(cache_usage_time.items(), key=lambda x: x[1])[0]
+            # Encuentra la clave menos recientemente usada (las claves fijadas nunca se desalojan)
+            oldest = min((item for item in cache_usage_time.items() if item[0] not in pinned_keys),
+                         key=lambda x: x[1], default=None)
+            if oldest:
+                oldest_key = oldest[0]
                 redis_client.delete(oldest_key)
                 del cache_usage_time[oldest_key]
-                logger.info(f"LRU: Eliminado {oldest_key} de la caché")
+                log_request(logger, "LRU: eliminado de la caché", key=oldest_key)
                 
         elif cache_policy == "LFU":
             # Encuentra la clave menos frecuentemente usada
-            if cache_hits_counter:
-                least_used_key = min(cache_hits_counter.items(), key=lambda x: x[1])[0]
+            least_used = min((item for item in cache_hits_counter.items() if item[0] not in pinned_keys),
+                             key=lambda x: x[1], default=None)
+            if least_used:
+                least_used_key = least_used[0]
                 redis_client.delete(least_used_key)
                 del cache_hits_counter[least_used_key]
-                logger.info(f"LFU: Eliminado {least_used_key} de la caché")
+                log_request(logger, "LFU: eliminado de la caché", key=least_used_key)
     except Exception as e:
         logger.error(f"Error en evicción de caché: {e}")
 
@@ -364,4 +1057,9 @@ if __name__ == '__main__':
     redis_client.set("current_distribution", current_distribution)
     distribution_switch_time = time.time() + 600
 
-    app.run(host='0.0.0.0', port=5000)
+    threading.Thread(target=listen_for_event_changes, daemon=True).start()
+    if HOT_PIN_COUNT > 0:
+        threading.Thread(target=pin_hot_keys, daemon=True).start()
+    threading.Thread(target=maintain_hot_set, daemon=True).start()
+
+    app.run(host='0.0.0.0', port=CACHE_PORT)
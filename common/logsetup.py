@@ -0,0 +1,151 @@
+"""
+Configuración de logging compartida por los servicios.
+
+Los registros se encolan con un QueueHandler y un hilo (QueueListener) los formatea y
+escribe en stdout, de modo que el hilo que atiende una solicitud nunca espera la
+escritura. Si la cola se llena los registros INFO/DEBUG se descartan en lugar de
+bloquear; las advertencias y errores se escriben directamente.
+Con LOG_FORMAT=json cada registro es un objeto JSON con sus campos estructurados.
+
+Los logs por solicitud se emiten con log_request(), que conserva una fracción
+LOG_SAMPLE_RATE de ellos; las advertencias y errores siempre se registran. El log de
+acceso de werkzeug (una línea por solicitud) se muestrea con la misma tasa.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "text" (legible) o "json" (un objeto por línea)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Fracción de logs por solicitud que se conservan (1 = todos, 0 = ninguno)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+# Registros pendientes de escribir como máximo; el resto se descarta
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Loggers de terceros con un registro INFO por solicitud, muestreados con LOG_SAMPLE_RATE
+SAMPLED_LOGGERS = ("werkzeug",)
+
+# Listener del proceso actual, registros descartados por cola llena y si ya se configuró
+listener = None
+dropped_records = 0
+configured = False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca espera a la cola: con la cola llena descarta los registros
+    INFO/DEBUG y escribe las advertencias y errores directamente con `fallback`.
+    """
+
+    def __init__(self, log_queue, fallback):
+        super().__init__(log_queue)
+        self.fallback = fallback
+
+    def prepare(self, record):
+        # La cola no sale del proceso: el formateo queda para el hilo del listener
+        return record
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                self.fallback.handle(record)
+            else:
+                dropped_records += 1
+
+
+class SamplingFilter(logging.Filter):
+    """Conserva una fracción LOG_SAMPLE_RATE de los registros INFO/DEBUG"""
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE
+
+
+class TextFormatter(logging.Formatter):
+    """Formato legible de siempre, con los campos estructurados como clave=valor"""
+
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por registro"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def start_listener(stream):
+    """Reemplaza los handlers del logger raíz por la cola y arranca el hilo que la escribe"""
+    global listener
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_FORMAT))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(DroppingQueueHandler(log_queue, handler))
+    root.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+def stop_listener():
+    """Escribe los registros pendientes y detiene el hilo"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def setup_logging(stream=None):
+    """
+    Configura el logging del proceso una sola vez (las llamadas siguientes no hacen nada).
+    Los procesos creados con fork (workers del generador, pool de ingesta) arrancan su
+    propio listener automáticamente.
+    """
+    global configured
+    if configured:
+        return
+    configured = True
+    stream = stream or sys.stdout
+    start_listener(stream)
+    for name in SAMPLED_LOGGERS:
+        logging.getLogger(name).addFilter(SamplingFilter())
+    atexit.register(stop_listener)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=lambda: start_listener(stream))
+
+def log_request(logger, message, **fields):
+    """
+    Log INFO por solicitud, muestreado con LOG_SAMPLE_RATE. Los campos se pasan por
+    separado para no formatear nada si el registro se descarta.
+    """
+    if LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    if logger.isEnabledFor(logging.INFO):
+        fields["sample_rate"] = LOG_SAMPLE_RATE
+        logger.info(message, extra={"fields": fields})
@@ -1,29 +1,99 @@
 import os
+import sys
 import json
 import time
 import logging
 import datetime
 import random
 import requests
+import redis
 import uuid
+import gzip
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
 
 
-USED_UUIDS = set()
+# UUIDs generados recientemente, acotados con desalojo del más antiguo
+USED_UUIDS = OrderedDict()
+USED_UUIDS_MAX = 100000
 
 def get_unique_uuid():
     """Genera un UUID garantizado único"""
     while True:
         new_uuid = str(uuid.uuid4())
         if new_uuid not in USED_UUIDS:
-            USED_UUIDS.add(new_uuid)
+            USED_UUIDS[new_uuid] = None
+            while len(USED_UUIDS) > USED_UUIDS_MAX:
+                USED_UUIDS.popitem(last=False)
             return new_uuid
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging compartido (common/logsetup.py, copiado junto a scraper.py en la imagen)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from logsetup import setup_logging
+
+setup_logging()
 logger = logging.getLogger('scraper')
 
+# Formato de los archivos de eventos: "json" (arreglo JSON, legado) o "ndjson" (un evento compacto por línea)
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "json")
+# Comprimir los archivos ndjson con gzip
+OUTPUT_GZIP = os.environ.get("OUTPUT_GZIP", "false").lower() in ("1", "true", "yes")
+
+# Consultas simultáneas a la API durante un barrido
+SCRAPER_CONCURRENCY = int(os.environ.get("SCRAPER_CONCURRENCY", "4"))
+# Máximo de solicitudes por segundo a un mismo host
+SCRAPER_MAX_RPS = float(os.environ.get("SCRAPER_MAX_RPS", "2"))
+# Reintentos ante errores de red o respuestas 429/5xx, con espera exponencial
+SCRAPER_MAX_RETRIES = int(os.environ.get("SCRAPER_MAX_RETRIES", "3"))
+SCRAPER_BACKOFF = float(os.environ.get("SCRAPER_BACKOFF", "1"))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Emitir solo los eventos nuevos, modificados o desaparecidos respecto de los barridos anteriores
+SCRAPER_DELTA = os.environ.get("SCRAPER_DELTA", "false").lower() in ("1", "true", "yes")
+# Cada cuántos barridos se emite igualmente el archivo completo (0 = nunca)
+DELTA_FULL_EVERY = int(os.environ.get("DELTA_FULL_EVERY", "12"))
+# Barridos consecutivos sin ver un evento antes de marcarlo como desaparecido
+DELTA_MISSING_SWEEPS = int(os.environ.get("DELTA_MISSING_SWEEPS", "2"))
+# Campos que cambian en cada barrido sin que el evento cambie
+FINGERPRINT_IGNORED_FIELDS = ("timestamp",)
+
+# Transporte hacia el loader: "file" (archivos en /data) o "stream" (Redis Stream,
+# con los archivos como respaldo)
+EVENTS_TRANSPORT = os.environ.get("EVENTS_TRANSPORT", "file")
+REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+EVENTS_STREAM = os.environ.get("EVENTS_STREAM", "events:ingest")
+# Entradas sin procesar admitidas en el stream; al alcanzarlo el scraper espera al loader
+STREAM_MAXLEN = int(os.environ.get("STREAM_MAXLEN", "100000"))
+# Espera máxima por espacio en el stream antes de recurrir a un archivo
+STREAM_BACKPRESSURE_TIMEOUT = float(os.environ.get("STREAM_BACKPRESSURE_TIMEOUT", "120"))
+# Eventos enviados en cada pipeline de XADD
+STREAM_CHUNK_SIZE = 500
+
+# Cliente Redis, creado al primer uso
+redis_client = None
+
+# Endpoint de la API de Waze LiveMap (se puede apuntar a un servidor local para benchmarks)
+WAZE_API_URL = os.environ.get("WAZE_API_URL", "https://www.waze.com/live-map/api/georss")
+# Si se define, cada respuesta cruda de la API se guarda en este directorio
+RECORD_DIR = os.environ.get("RECORD_DIR", "")
+
+# Sesión HTTP compartida con un pool de conexiones keep-alive
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=SCRAPER_CONCURRENCY, pool_maxsize=SCRAPER_CONCURRENCY))
+http_session.mount("http://", HTTPAdapter(pool_connections=SCRAPER_CONCURRENCY, pool_maxsize=SCRAPER_CONCURRENCY))
+
+# Próximo instante en que se puede enviar una solicitud a cada host
+rate_limit_lock = threading.Lock()
+next_request_time = {}
+
 # Definición del bounding box de la Región Metropolitana
 # Estas coordenadas forman un rectángulo que cubre toda la RM
 RM_BOUNDING_BOX = {
@@ -33,77 +103,89 @@ RM_BOUNDING_BOX = {
     "max_lon": -70.41   # Este
 }
 
-# División en cuadrantes para consultas más efectivas
-def generate_quadrants(bbox, grid_size=2):
-    """Divide el área en cuadrantes para consultas más pequeñas"""
-    quadrants = []
-    
-    lat_step = (bbox["max_lat"] - bbox["min_lat"]) / grid_size
-    lon_step = (bbox["max_lon"] - bbox["min_lon"]) / grid_size
-    
-    for i in range(grid_size):
-        for j in range(grid_size):
-            min_lat = bbox["min_lat"] + (i * lat_step)
-            max_lat = bbox["min_lat"] + ((i + 1) * lat_step)
-            min_lon = bbox["min_lon"] + (j * lon_step)
-            max_lon = bbox["min_lon"] + ((j + 1) * lon_step)
-            
-            # Calcular el centro del cuadrante
-            center_lat = (min_lat + max_lat) / 2
-            center_lon = (min_lon + max_lon) / 2
-            
-            quadrant = {
-                "min_lat": min_lat,
-                "max_lat": max_lat,
-                "min_lon": min_lon,
-                "max_lon": max_lon,
-                "lat": center_lat,    
-                "lon": center_lon,    
-                "name": f"RM Cuadrante {i+1}-{j+1}"
-            }
-            quadrants.append(quadrant)
-    
-    logger.info(f"Área dividida en {len(quadrants)} cuadrantes para consultas")
-    return quadrants
-
-# Generar cuadrantes para toda la región
-RM_QUADRANTS = generate_quadrants(RM_BOUNDING_BOX, grid_size=3)
-
-# Agregar después de las definiciones de RM_QUADRANTS
-
-# Mapeo de cuadrantes a comunas
-QUADRANT_TO_COMUNA = {
-    "1-1": "Maipú/Padre Hurtado",
-    "1-2": "San Bernardo/Buin",
-    "1-3": "Puente Alto/La Florida",
-    "2-1": "Pudahuel/Cerro Navia",
-    "2-2": "Santiago Centro/Estación Central",
-    "2-3": "Las Condes/Providencia",
-   
-}
+# Máximo de resultados por tipo que devuelve la API en una consulta (parámetro ma)
+WAZE_MAX_RESULTS = 600
+# Archivo donde se conserva la subdivisión aprendida entre ciclos (oculto para el loader)
+TILING_FILE = os.environ.get("TILING_FILE", "/data/.scraper_tiling.json")
+# Profundidad máxima del quadtree (cada nivel divide la celda en 4)
+TILING_MAX_DEPTH = int(os.environ.get("TILING_MAX_DEPTH", "6"))
+# Una celda es escasa si devuelve menos de esta fracción del máximo de resultados
+SPARSE_FRACTION = 0.1
+# Barridos seguidos en que las 4 celdas hermanas deben ser escasas para fusionarse
+MERGE_AFTER_SWEEPS = int(os.environ.get("MERGE_AFTER_SWEEPS", "3"))
 
-# Función para determinar la comuna basada en coordenadas
-def get_comuna_from_coordinates(lat, lon):
-    """Determina la comuna basada en coordenadas geográficas"""
-   
-    
-    # Comunas del sector oriente
-    if lat > -33.42 and lon > -70.58:
-        return "Las Condes"
-    elif lat > -33.45 and lon > -70.60:
-        return "Providencia"
-    elif lat > -33.51 and lon > -70.58:
-        return "La Florida"
-    elif lat < -33.55 and lon > -70.60:
-        return "Puente Alto"
-    elif lat < -33.60 and lon < -70.70:
-        return "San Bernardo"
-    elif lat < -33.50 and lon < -70.75:
-        return "Maipú"
-    elif lat > -33.45 and lon < -70.68:
-        return "Santiago Centro"
-  
-    return "Región Metropolitana"
+def cell_for_path(path):
+    """
+    Construye la celda del quadtree identificada por path.
+    path es una cadena de dígitos 0-3 (0=SO, 1=SE, 2=NO, 3=NE) desde la RM completa ("").
+    """
+    bbox = dict(RM_BOUNDING_BOX)
+    for digit in path:
+        mid_lat = (bbox["min_lat"] + bbox["max_lat"]) / 2
+        mid_lon = (bbox["min_lon"] + bbox["max_lon"]) / 2
+        index = int(digit)
+        if index & 2:
+            bbox["min_lat"] = mid_lat
+        else:
+            bbox["max_lat"] = mid_lat
+        if index & 1:
+            bbox["min_lon"] = mid_lon
+        else:
+            bbox["max_lon"] = mid_lon
+    return {
+        **bbox,
+        "lat": (bbox["min_lat"] + bbox["max_lat"]) / 2,
+        "lon": (bbox["min_lon"] + bbox["max_lon"]) / 2,
+        "name": f"RM Celda {path or 'raíz'}",
+        "path": path
+    }
+
+def load_tiling():
+    """Carga la subdivisión aprendida: {path: barridos seguidos en que la celda fue escasa}"""
+    try:
+        with open(TILING_FILE, 'r', encoding='utf-8') as f:
+            tiling = json.load(f)
+        if tiling:
+            logger.info(f"Subdivisión cargada con {len(tiling)} celdas")
+            return tiling
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"No se pudo cargar la subdivisión guardada: {e}")
+    # Sin estado previo se parte de la región completa y se subdivide según haga falta
+    return {"": 0}
+
+def save_tiling(tiling):
+    """Guarda la subdivisión aprendida de forma atómica"""
+    try:
+        os.makedirs(os.path.dirname(TILING_FILE), exist_ok=True)
+        tmp_file = TILING_FILE + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(tiling, f)
+        os.replace(tmp_file, TILING_FILE)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar la subdivisión: {e}")
+
+def merge_sparse_cells(tiling, counts):
+    """
+    Actualiza las rachas de celdas escasas y fusiona en su padre cada grupo de 4
+    hermanas que lleva MERGE_AFTER_SWEEPS barridos con pocos resultados.
+    """
+    for path, count in counts.items():
+        if path in tiling:
+            tiling[path] = tiling[path] + 1 if count < WAZE_MAX_RESULTS * SPARSE_FRACTION else 0
+
+    parents = {path[:-1] for path in tiling if path}
+    for parent in parents:
+        siblings = [parent + digit for digit in "0123"]
+        if not all(s in tiling and s in counts for s in siblings):
+            continue
+        if (all(tiling[s] >= MERGE_AFTER_SWEEPS for s in siblings)
+                and sum(counts[s] for s in siblings) < WAZE_MAX_RESULTS * SPARSE_FRACTION * 4):
+            for s in siblings:
+                del tiling[s]
+            tiling[parent] = 0
+            logger.info(f"Celdas {', '.join(siblings)} fusionadas en {cell_for_path(parent)['name']}")
 
 # User-Agents para rotar
 USER_AGENTS = [
@@ -117,144 +199,258 @@ def get_random_user_agent():
     """Devuelve un User-Agent aleatorio de la lista"""
     return random.choice(USER_AGENTS)
 
-def get_traffic_data_for_quadrant(quadrant):
-    """Obtiene datos de tráfico para un cuadrante usando la API de Waze"""
+def wait_for_rate_limit(url):
+    """Espera el turno del host para no superar SCRAPER_MAX_RPS solicitudes por segundo"""
+    if SCRAPER_MAX_RPS <= 0:
+        return
+    host = urlparse(url).netloc
+    with rate_limit_lock:
+        now = time.time()
+        scheduled = max(now, next_request_time.get(host, now))
+        next_request_time[host] = scheduled + 1.0 / SCRAPER_MAX_RPS
+    if scheduled > now:
+        time.sleep(scheduled - now)
+
+def record_response(quadrant, data):
+    """Guarda una respuesta cruda de la API junto con su cuadrante, para reproducirla offline"""
     try:
-        logger.info(f"Obteniendo datos de tráfico para {quadrant['name']}...")
-        
-        # URL de la API de Waze LiveMap 
-        url = f"https://www.waze.com/live-map/api/georss?bottom={quadrant['min_lat']}&left={quadrant['min_lon']}&top={quadrant['max_lat']}&right={quadrant['max_lon']}&env=row&ma=600&types=alerts,traffic"
-        
-        headers = {
-            "User-Agent": get_random_user_agent(),
-            "Referer": "https://www.waze.com/live-map",
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "es-ES,es;q=0.9,en;q=0.8",
-            "Origin": "https://www.waze.com",
-            "Cache-Control": "no-cache"
-        }
-        
-        response = requests.get(url, headers=headers, timeout=15)
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+        cell = quadrant["name"].replace(" ", "_").replace("/", "-")
+        filename = os.path.join(RECORD_DIR, f"waze_{timestamp}_{cell}.json")
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({"quadrant": quadrant, "response": data}, f, ensure_ascii=False)
+    except Exception as e:
+        logger.error(f"Error guardando la respuesta de {quadrant['name']}: {e}")
+
+def fetch_quadrant_data(quadrant):
+    """
+    Descarga la respuesta cruda de la API de Waze para un cuadrante.
+    Reintenta con espera exponencial ante errores de red o respuestas 429/5xx.
+    Devuelve el JSON recibido o None si no se pudo obtener.
+    """
+    # URL de la API de Waze LiveMap 
+    url = f"{WAZE_API_URL}?bottom={quadrant['min_lat']}&left={quadrant['min_lon']}&top={quadrant['max_lat']}&right={quadrant['max_lon']}&env=row&ma={WAZE_MAX_RESULTS}&types=alerts,traffic"
+    
+    headers = {
+        "User-Agent": get_random_user_agent(),
+        "Referer": "https://www.waze.com/live-map",
+        "Accept": "application/json, text/plain, */*",
+        "Accept-Language": "es-ES,es;q=0.9,en;q=0.8",
+        "Origin": "https://www.waze.com",
+        "Cache-Control": "no-cache"
+    }
+    
+    for attempt in range(SCRAPER_MAX_RETRIES + 1):
+        wait_for_rate_limit(url)
+        try:
+            response = http_session.get(url, headers=headers, timeout=15)
+            if response.status_code == 200:
+                data = response.json()
+                if RECORD_DIR:
+                    record_response(quadrant, data)
+                return data
+            if response.status_code not in RETRYABLE_STATUS:
+                logger.warning(f"Error al obtener datos para {quadrant['name']}: Código {response.status_code}")
+                return None
+            error = f"Código {response.status_code}"
+        except (RequestException, ValueError) as e:
+            error = str(e)
         
-        if response.status_code == 200:
-            logger.info(f"Datos obtenidos exitosamente para {quadrant['name']}")
-            return process_waze_data(response.json(), quadrant)
+        if attempt < SCRAPER_MAX_RETRIES:
+            wait_time = SCRAPER_BACKOFF * (2 ** attempt) + random.uniform(0, SCRAPER_BACKOFF)
+            logger.warning(f"Error al obtener datos para {quadrant['name']} ({error}), "
+                           f"reintento {attempt + 1}/{SCRAPER_MAX_RETRIES} en {wait_time:.1f}s")
+            time.sleep(wait_time)
         else:
-            logger.warning(f"Error al obtener datos para {quadrant['name']}: Código {response.status_code}")
-            return []
+            logger.error(f"Error obteniendo datos para {quadrant['name']}: {error}")
+    return None
+
+def get_cell_data(quadrant):
+    """
+    Obtiene los eventos de un cuadrante o celda.
+    Devuelve (eventos, resultados recibidos, truncado); resultados es None si la consulta falló.
+    """
+    try:
+        logger.info(f"Obteniendo datos de tráfico para {quadrant['name']}...")
+        data = fetch_quadrant_data(quadrant)
+        if data is None:
+            return [], None, False
+        logger.info(f"Datos obtenidos exitosamente para {quadrant['name']}")
+        alerts = data.get("alerts") or []
+        jams = data.get("jams") or []
+        # Si la API devolvió el máximo, probablemente faltan resultados en la celda
+        truncated = len(alerts) >= WAZE_MAX_RESULTS or len(jams) >= WAZE_MAX_RESULTS
+        return process_waze_data(data, quadrant), len(alerts) + len(jams), truncated
             
     except Exception as e:
         logger.error(f"Error obteniendo datos para {quadrant['name']}: {e}")
-        return []
+        return [], None, False
+
+def get_traffic_data_for_quadrant(quadrant):
+    """Obtiene datos de tráfico para un cuadrante usando la API de Waze"""
+    return get_cell_data(quadrant)[0]
+
+def sweep_tiling(tiling):
+    """
+    Recorre todas las celdas de la subdivisión en paralelo.
+    Las celdas cuya respuesta llega al máximo se dividen en 4 y se consultan en el mismo barrido.
+    Devuelve los eventos (sin duplicados), la cantidad de solicitudes hechas y las celdas
+    incompletas (consulta fallida, o truncada en la profundidad máxima).
+    """
+    events_by_uuid = {}
+    counts = {}
+    incomplete = []
+    requests_made = 0
+    pending = [cell_for_path(path) for path in sorted(tiling)]
+
+    with ThreadPoolExecutor(max_workers=SCRAPER_CONCURRENCY) as executor:
+        while pending:
+            results = list(executor.map(get_cell_data, pending))
+            requests_made += len(pending)
+            next_pending = []
+            for cell, (events, count, truncated) in zip(pending, results):
+                for event in events:
+                    events_by_uuid[event["uuid"]] = event
+                path = cell["path"]
+                if truncated and len(path) < TILING_MAX_DEPTH:
+                    del tiling[path]
+                    children = [cell_for_path(path + digit) for digit in "0123"]
+                    for child in children:
+                        tiling[child["path"]] = 0
+                    next_pending.extend(children)
+                    logger.info(f"{cell['name']} llegó al máximo de resultados, se divide en 4")
+                elif count is not None:
+                    counts[path] = count
+                if count is None or (truncated and len(path) >= TILING_MAX_DEPTH):
+                    incomplete.append(cell)
+            pending = next_pending
+
+    merge_sparse_cells(tiling, counts)
+    return list(events_by_uuid.values()), requests_made, incomplete
+
+def to_coordinates(lat, lon, quadrant):
+    """Convierte lat/lon a float, usando el centro del cuadrante si no son válidos"""
+    try:
+        return float(lat), float(lon)
+    except (TypeError, ValueError):
+        return quadrant["lat"], quadrant["lon"]
+
+def alert_coordinates(alert, quadrant):
+    """Coordenadas de una alerta de Waze"""
+    try:
+        location = alert.get("location", {})
+        return to_coordinates(location.get("y", quadrant["lat"]), location.get("x", quadrant["lon"]), quadrant)
+    except AttributeError:
+        return quadrant["lat"], quadrant["lon"]
+
+def jam_coordinates(jam, quadrant):
+    """Coordenadas de una congestión de Waze: el primer punto de su línea"""
+    try:
+        if "line" in jam and isinstance(jam["line"], list) and len(jam["line"]) > 0:
+            return to_coordinates(jam["line"][0].get("y", quadrant["lat"]), jam["line"][0].get("x", quadrant["lon"]), quadrant)
+    except (AttributeError, TypeError):
+        pass
+    return quadrant["lat"], quadrant["lon"]
 
 def process_waze_data(data, quadrant):
     """Procesa los datos obtenidos de la API de Waze"""
     events = []
+    alerts = data["alerts"] if isinstance(data.get("alerts"), list) else []
+    jams = data["jams"] if isinstance(data.get("jams"), list) else []
+    
+    # Determinar la comuna de todas las alertas y congestiones en una sola consulta vectorizada
+    coordinates = [alert_coordinates(alert, quadrant) for alert in alerts]
+    coordinates += [jam_coordinates(jam, quadrant) for jam in jams]
+    comunas = assign_comunas([c[0] for c in coordinates], [c[1] for c in coordinates])
     
     # Procesar alertas (accidentes, peligros, policía, etc.)
-    if "alerts" in data and isinstance(data["alerts"], list):
-        for alert in data["alerts"]:
-            try:
-                # Obtener tipo de alerta
-                alert_type = map_type(alert.get("type", ""))
-                
-                # Obtener coordenadas
-                lat = alert.get("location", {}).get("y", quadrant["lat"])
-                lon = alert.get("location", {}).get("x", quadrant["lon"])
-                
-                # Determinar la comuna basada en coordenadas
-                comuna = get_comuna_from_coordinates(lat, lon)
-                
-                # Crear descripción adecuada
-                if "reportDescription" in alert and alert["reportDescription"]:
-                    description = alert["reportDescription"]
-                elif "street" in alert and alert["street"]:
-                    description = f"{alert_type.title()} en {alert['street']}"
-                else:
-                    description = f"{alert_type.title()} en {comuna}"
-                
-                # Usar el ID de Waze, o generar uno si no existe
-                waze_id = alert.get("id", None) or alert.get("uuid", None)
-                if not waze_id:
-                    # Si Waze no proporciona ID, generamos uno
-                    waze_id = str(uuid.uuid4())
-                else:
-                    # Añadir prefijo para indicar que es un ID de Waze
-                    waze_id = f"waze_{waze_id}"
-                
-                # Crear evento
-                event = {
-                    "uuid": waze_id,
-                    "type": alert_type,
-                    "location": f"{lat},{lon}",
-                    "location_desc": comuna,
-                    "description": description,
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "source": "waze_api",
-                    "waze_id": alert.get("id", "")  
-                }
-                
-                events.append(event)
-                
-            except Exception as e:
-                logger.error(f"Error procesando alerta: {e}")
+    for i, alert in enumerate(alerts):
+        try:
+            # Obtener tipo de alerta
+            alert_type = map_type(alert.get("type", ""))
+            
+            lat, lon = coordinates[i]
+            comuna = comunas[i]
+            
+            # Crear descripción adecuada
+            if "reportDescription" in alert and alert["reportDescription"]:
+                description = alert["reportDescription"]
+            elif "street" in alert and alert["street"]:
+                description = f"{alert_type.title()} en {alert['street']}"
+            else:
+                description = f"{alert_type.title()} en {comuna}"
+            
+            # Usar el ID de Waze, o generar uno si no existe
+            waze_id = alert.get("id", None) or alert.get("uuid", None)
+            if not waze_id:
+                # Si Waze no proporciona ID, generamos uno
+                waze_id = str(uuid.uuid4())
+            else:
+                # Añadir prefijo para indicar que es un ID de Waze
+                waze_id = f"waze_{waze_id}"
+            
+            # Crear evento
+            event = {
+                "uuid": waze_id,
+                "type": alert_type,
+                "location": f"{lat},{lon}",
+                "location_desc": comuna,
+                "description": description,
+                "timestamp": datetime.datetime.now().isoformat(),
+                "source": "waze_api",
+                "waze_id": alert.get("id", "")  
+            }
+            
+            events.append(event)
+            
+        except Exception as e:
+            logger.error(f"Error procesando alerta: {e}")
     
     # Procesar atascos/congestiones de manera similar
-    if "jams" in data and isinstance(data["jams"], list):
-        for jam in data["jams"]:
-            try:
-                # Obtener coordenadas
-                if "line" in jam and isinstance(jam["line"], list) and len(jam["line"]) > 0:
-                    lat = jam["line"][0].get("y", quadrant["lat"])
-                    lon = jam["line"][0].get("x", quadrant["lon"])
-                else:
-                    lat, lon = quadrant["lat"], quadrant["lon"]
-                
-                # Determinar comuna basada en coordenadas
-                comuna = get_comuna_from_coordinates(lat, lon)
-                
-                # Crear descripción
-                if "street" in jam and jam["street"]:
-                    description = f"Congestión en {jam['street']}"
-                else:
-                    description = f"Congestión de tráfico en {comuna}"
-                
-                # Usar el ID de Waze, o generar uno si no existe
-                waze_id = jam.get("uuid", None) or jam.get("jamId", None)
-                if not waze_id:
-                    waze_id = str(uuid.uuid4())
-                else:
-                    waze_id = f"waze_{waze_id}"
-                
-                # Crear evento
-                event = {
-                    "uuid": waze_id,
-                    "type": "traffic_jam",
-                    "location": f"{lat},{lon}",
-                    "location_desc": comuna,
-                    "description": description,
-                    "timestamp": datetime.datetime.now().isoformat(),
-                    "source": "waze_api",
-                    "length_meters": jam.get("length", 0),
-                    "speed": jam.get("speed", 0),
-                    "congestion_level": jam.get("level", 0),
-                    "delay_seconds": jam.get("delay", -1),
-                    "waze_id": jam.get("jamId", "")  
-                }
-                
-                events.append(event)
-                
-            except Exception as e:
-                logger.error(f"Error procesando congestión: {e}")
+    for i, jam in enumerate(jams, start=len(alerts)):
+        try:
+            lat, lon = coordinates[i]
+            comuna = comunas[i]
+            
+            # Crear descripción
+            if "street" in jam and jam["street"]:
+                description = f"Congestión en {jam['street']}"
+            else:
+                description = f"Congestión de tráfico en {comuna}"
+            
+            # Usar el ID de Waze, o generar uno si no existe
+            waze_id = jam.get("uuid", None) or jam.get("jamId", None)
+            if not waze_id:
+                waze_id = str(uuid.uuid4())
+            else:
+                waze_id = f"waze_{waze_id}"
+            
+            # Crear evento
+            event = {
+                "uuid": waze_id,
+                "type": "traffic_jam",
+                "location": f"{lat},{lon}",
+                "location_desc": comuna,
+                "description": description,
+                "timestamp": datetime.datetime.now().isoformat(),
+                "source": "waze_api",
+                "length_meters": jam.get("length", 0),
+                "speed": jam.get("speed", 0),
+                "congestion_level": jam.get("level", 0),
+                "delay_seconds": jam.get("delay", -1),
+                "waze_id": jam.get("jamId", "")  
+            }
+            
+            events.append(event)
+            
+        except Exception as e:
+            logger.error(f"Error procesando congestión: {e}")
     
-    # Determinar la comuna representativa del cuadrante
-    comuna_representativa = get_comuna_from_coordinates(quadrant["lat"], quadrant["lon"])
+    # Comuna representativa de la celda, según la grilla de comunas
+    comuna_representativa = get_nearest_comuna(quadrant["lat"], quadrant["lon"])
 
-    # Alternativa: extraer el ID del cuadrante y usar el mapeo predefinido
-    quadrant_id = quadrant["name"].replace("RM Cuadrante ", "")
-    comuna_mapeo = QUADRANT_TO_COMUNA.get(quadrant_id, comuna_representativa)
-
-    logger.info(f"Extraídos {len(events)} eventos para {comuna_mapeo}")
+    logger.info(f"Extraídos {len(events)} eventos para {quadrant['name']} ({comuna_representativa})")
 
     # Obtener distribución de comunas
     if events:
@@ -304,22 +500,49 @@ COMUNAS_RM = [
     {"name": "Maipú", "lat": -33.5167, "lon": -70.7667}
 ]
 
+# Resolución (en grados) de la grilla de comunas precalculada, ~250 m
+COMUNA_GRID_STEP = 0.0025
+COMUNA_NAMES = np.array([comuna["name"] for comuna in COMUNAS_RM] + ["Región Metropolitana"])
+
+def build_comuna_grid(bbox, step):
+    """
+    Precalcula, para cada celda de una grilla lat/lon sobre el bounding box,
+    el índice de la comuna con el centroide más cercano.
+    """
+    lats = np.arange(bbox["min_lat"], bbox["max_lat"], step) + step / 2
+    lons = np.arange(bbox["min_lon"], bbox["max_lon"], step) + step / 2
+    centroid_lats = np.array([comuna["lat"] for comuna in COMUNAS_RM])
+    centroid_lons = np.array([comuna["lon"] for comuna in COMUNAS_RM])
+    # Distancia euclidiana al cuadrado (suficiente para comparar), fila por fila para acotar memoria
+    grid = np.empty((len(lats), len(lons)), dtype=np.int16)
+    for i, lat in enumerate(lats):
+        distances = (centroid_lats[None, :] - lat) ** 2 + (centroid_lons[None, :] - lons[:, None]) ** 2
+        grid[i] = distances.argmin(axis=1)
+    return grid
+
+COMUNA_GRID = build_comuna_grid(RM_BOUNDING_BOX, COMUNA_GRID_STEP)
+
+def assign_comunas(lats, lons):
+    """
+    Asigna la comuna más cercana a un lote de coordenadas con una búsqueda en la grilla.
+    Los puntos fuera de la Región Metropolitana quedan como "Región Metropolitana".
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    if lats.size == 0:
+        return []
+    rows = np.floor((np.nan_to_num(lats, nan=-1e9) - RM_BOUNDING_BOX["min_lat"]) / COMUNA_GRID_STEP)
+    cols = np.floor((np.nan_to_num(lons, nan=-1e9) - RM_BOUNDING_BOX["min_lon"]) / COMUNA_GRID_STEP)
+    inside = (rows >= 0) & (rows < COMUNA_GRID.shape[0]) & (cols >= 0) & (cols < COMUNA_GRID.shape[1])
+    indices = np.full(lats.shape, len(COMUNAS_RM), dtype=np.int16)
+    indices[inside] = COMUNA_GRID[rows[inside].astype(int), cols[inside].astype(int)]
+    return COMUNA_NAMES[indices].tolist()
+
 def get_nearest_comuna(lat, lon):
     """Encuentra la comuna más cercana a las coordenadas dadas"""
     if not lat or not lon:
         return "Región Metropolitana"
-        
-    min_distance = float('inf')
-    nearest_comuna = "Región Metropolitana"
-    
-    for comuna in COMUNAS_RM:
-        # Cálculo simple de distancia euclidiana (suficiente para comparación)
-        distance = ((comuna["lat"] - lat) ** 2 + (comuna["lon"] - lon) ** 2) ** 0.5
-        if distance < min_distance:
-            min_distance = distance
-            nearest_comuna = comuna["name"]
-    
-    return nearest_comuna
+    return assign_comunas([lat], [lon])[0]
 
 def map_type(waze_type):
     """Mapea tipos de Waze a nuestras categorías"""
@@ -341,7 +564,7 @@ def map_type(waze_type):
     return type_mapping.get(normalized_type, "hazard")
 
 def save_to_file(events):
-    """Guarda los eventos en un archivo JSON con verificación de UUID"""
+    """Guarda los eventos en un archivo (JSON o JSON por línea) con verificación de UUID"""
     if not events:
         logger.warning("No hay eventos para guardar")
         return
@@ -358,16 +581,131 @@ def save_to_file(events):
         
         # Crear nombre de archivo con timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = f"/data/events_{timestamp}.json"
+        if OUTPUT_FORMAT == "ndjson":
+            filename = f"/data/events_{timestamp}.ndjson" + (".gz" if OUTPUT_GZIP else "")
+        else:
+            filename = f"/data/events_{timestamp}.json"
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(events, f, ensure_ascii=False, indent=2)
+        # Escribir en un archivo oculto y renombrar, para que el loader nunca lea un archivo a medias
+        tmp_filename = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename))
+        if OUTPUT_FORMAT == "ndjson":
+            opener = gzip.open if OUTPUT_GZIP else open
+            with opener(tmp_filename, 'wt', encoding='utf-8') as f:
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+                    f.write('\n')
+        else:
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
+                json.dump(events, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_filename, filename)
         
         logger.info(f"Guardados {len(events)} eventos en {filename}")
         
     except Exception as e:
         logger.error(f"Error guardando archivo: {e}")
 
+# Huella de cada evento visto en los últimos barridos: uuid -> [huella, barridos sin verlo, (lat, lon)]
+sweep_index = {}
+
+def event_fingerprint(event):
+    """Huella compacta (8 bytes) de los campos significativos de un evento"""
+    content = {k: v for k, v in event.items() if k not in FINGERPRINT_IGNORED_FIELDS}
+    encoded = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=8).digest()
+
+def event_position(event):
+    """Coordenadas (lat, lon) de un evento, o None si su ubicación no es válida"""
+    try:
+        lat, lon = (float(part) for part in event["location"].split(','))
+        return lat, lon
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+def in_cells(position, cells):
+    """Indica si una posición cae en alguna de las celdas (o si no se conoce la posición)"""
+    if position is None:
+        return bool(cells)
+    lat, lon = position
+    return any(cell["min_lat"] <= lat <= cell["max_lat"] and cell["min_lon"] <= lon <= cell["max_lon"]
+               for cell in cells)
+
+def compute_delta(events, index, full=False, incomplete_cells=()):
+    """
+    Compara un barrido con el índice de huellas y devuelve los eventos a emitir:
+    los nuevos o modificados, y un marcador {"uuid", "expired", "expired_at"} por cada
+    evento que lleva DELTA_MISSING_SWEEPS barridos sin aparecer. Con full=True se
+    emiten todos los eventos del barrido. El índice se actualiza en el lugar y solo
+    conserva los eventos vistos en los últimos barridos.
+    Los eventos de celdas incompletas en este barrido (consulta fallida o truncada) no
+    cuentan como ausentes: no haberlos visto no significa que hayan desaparecido.
+    """
+    delta = []
+    seen = set()
+    new_count = changed_count = 0
+    for event in events:
+        fingerprint = event_fingerprint(event)
+        entry = index.get(event["uuid"])
+        if entry is None:
+            new_count += 1
+        elif entry[0] != fingerprint:
+            changed_count += 1
+        if full or entry is None or entry[0] != fingerprint:
+            delta.append(event)
+        index[event["uuid"]] = [fingerprint, 0, event_position(event)]
+        seen.add(event["uuid"])
+
+    expired_at = datetime.datetime.now().isoformat()
+    expired = []
+    for event_uuid, entry in index.items():
+        if event_uuid in seen or in_cells(entry[2], incomplete_cells):
+            continue
+        entry[1] += 1
+        if entry[1] >= DELTA_MISSING_SWEEPS:
+            expired.append(event_uuid)
+    for event_uuid in expired:
+        del index[event_uuid]
+        delta.append({"uuid": event_uuid, "expired": True, "expired_at": expired_at})
+
+    logger.info(f"Delta del barrido: {new_count} nuevos, {changed_count} modificados, "
+                f"{len(expired)} desaparecidos, {len(events) - new_count - changed_count} sin cambios")
+    return delta
+
+def publish_to_stream(events):
+    """
+    Agrega los eventos al stream de ingesta en pipelines de STREAM_CHUNK_SIZE XADD.
+    El loader borra las entradas ya escritas, así que el largo del stream es el trabajo
+    pendiente: si supera STREAM_MAXLEN se espera hasta STREAM_BACKPRESSURE_TIMEOUT.
+    Devuelve los eventos que no se pudieron publicar, para guardarlos en un archivo.
+    """
+    global redis_client
+    start = 0
+    try:
+        if redis_client is None:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        for start in range(0, len(events), STREAM_CHUNK_SIZE):
+            chunk = events[start:start + STREAM_CHUNK_SIZE]
+            deadline = time.time() + STREAM_BACKPRESSURE_TIMEOUT
+            while True:
+                backlog = redis_client.xlen(EVENTS_STREAM)
+                if backlog == 0 or backlog + len(chunk) <= STREAM_MAXLEN:
+                    break
+                if time.time() >= deadline:
+                    logger.warning(f"Stream {EVENTS_STREAM} lleno ({backlog} entradas pendientes), "
+                                   f"se guardan {len(events) - start} eventos en archivo")
+                    return events[start:]
+                time.sleep(1)
+            pipe = redis_client.pipeline(transaction=False)
+            for event in chunk:
+                # MAXLEN aproximado solo como tope de seguridad si el loader no borra entradas
+                pipe.xadd(EVENTS_STREAM, {"event": json.dumps(event, ensure_ascii=False, separators=(',', ':'))},
+                          maxlen=STREAM_MAXLEN, approximate=True)
+            pipe.execute()
+        logger.info(f"Publicados {len(events)} eventos en el stream {EVENTS_STREAM}")
+        return []
+    except Exception as e:
+        logger.error(f"Error publicando en el stream {EVENTS_STREAM}: {e}")
+        return events[start:]
+
 def get_comunas_distribution(events):
     """Obtiene la distribución de comunas en los eventos"""
     comunas = {}
@@ -382,20 +720,23 @@ def get_comunas_distribution(events):
 def main():
     """Función principal del scraper"""
     logger.info("Iniciando servicio de obtención de datos de tráfico para la Región Metropolitana con bounding box")
+    tiling = load_tiling()
+    sweeps = 0
     
     while True:
         try:
-            all_events = []
-            
-            # Obtener datos de cada cuadrante de la región
-            for quadrant in RM_QUADRANTS:
-                events = get_traffic_data_for_quadrant(quadrant)
-                if events:
-                    all_events.extend(events)
+            # Obtener datos de todas las celdas de la región
+            sweep_start = time.time()
+            all_events, requests_made, incomplete_cells = sweep_tiling(tiling)
+            save_tiling(tiling)
+            logger.info(f"Barrido de {requests_made} solicitudes completado en "
+                        f"{time.time() - sweep_start:.1f}s ({len(all_events)} eventos, "
+                        f"{len(tiling)} celdas en la subdivisión)")
             
             # Si no se obtuvieron eventos reales, registrar un error y continuar
             if not all_events:
                 logger.error("No se obtuvieron datos reales en este ciclo.")
+                time.sleep(60)
                 continue
             
             # Verificar que cada evento tenga UUID, pero no sobrescribir los de Waze
@@ -409,8 +750,20 @@ def main():
                 if "report_count" in event:
                     del event["report_count"]
             
-            # Guardar los eventos en un archivo
-            save_to_file(all_events)
+            # Guardar los eventos (o solo los cambios respecto del barrido anterior) en un archivo
+            if SCRAPER_DELTA:
+                full = DELTA_FULL_EVERY > 0 and sweeps % DELTA_FULL_EVERY == 0
+                all_events = compute_delta(all_events, sweep_index, full=full, incomplete_cells=incomplete_cells)
+            sweeps += 1
+            if not all_events:
+                logger.info("Sin cambios respecto del barrido anterior, no se genera archivo")
+            elif EVENTS_TRANSPORT == "stream":
+                # Lo que no se pudo publicar queda en un archivo como respaldo
+                unpublished = publish_to_stream(all_events)
+                if unpublished:
+                    save_to_file(unpublished)
+            else:
+                save_to_file(all_events)
             
             # Esperar para el próximo ciclo (entre 5 y 10 minutos)
             wait_time = random.randint(300, 600)
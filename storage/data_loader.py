@@ -1,16 +1,119 @@
 import os
+import sys
 import json
 import time
 import logging
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReplaceOne, ASCENDING, DESCENDING, GEOSPHERE
+from pymongo.errors import BulkWriteError, OperationFailure
+import redis
 import datetime
 import shutil
+import gzip
+import queue
+import socket
+import hashlib
+import threading
+import tarfile
+import re
+import math
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # Sin watchdog se usa solo el sondeo periódico
+    Observer = None
+    FileSystemEventHandler = object
+
+# Logging compartido (common/logsetup.py, copiado junto a data_loader.py en la imagen)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from logsetup import setup_logging
+
+setup_logging()
 logger = logging.getLogger('data_loader')
 
+# Cantidad de upserts enviados a MongoDB en cada bulk_write
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "1000"))
+
+# Formatos de archivo aceptados: arreglos JSON (legado) y JSON por línea, opcionalmente comprimidos
+EVENT_FILE_SUFFIXES = ('.json', '.json.gz', '.ndjson', '.ndjson.gz')
+
+# Tamaño de lectura al recorrer un arreglo JSON de forma incremental
+READ_CHUNK_SIZE = 64 * 1024
+
+# Campos que cambian en cada ciclo del scraper y no forman parte del hash de contenido
+VOLATILE_FIELDS = ('_id', 'timestamp', 'processed_at', 'updated_at', 'last_seen', 'content_hash')
+# Un evento re-emitido sin cambios actualiza last_seen como mucho una vez por este intervalo (segundos)
+LAST_SEEN_RESOLUTION = int(os.environ.get("LAST_SEEN_RESOLUTION", "60"))
+# Código de MongoDB de una inserción que viola el índice único de uuid
+DUPLICATE_KEY_ERROR = 11000
+
+# Colección con el avance de ingesta de cada archivo, y cuánto se conservan sus entradas
+JOURNAL_COLLECTION = "ingest_journal"
+JOURNAL_TTL_SECONDS = int(os.environ.get("JOURNAL_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Migraciones en segundo plano de documentos anteriores a los campos geo y last_seen
+GEO_MIGRATION_BATCH_SIZE = int(os.environ.get("GEO_MIGRATION_BATCH_SIZE", "500"))
+GEO_MIGRATION_PAUSE = float(os.environ.get("GEO_MIGRATION_PAUSE", "0.5"))
+
+# Colección de agregados por comuna, tipo y hora
+ROLLUP_COLLECTION = "event_rollups"
+
+# Retención de eventos: "none" (sin límite), "ttl" (MongoDB los borra) o "archive"
+# (se mueven a colecciones mensuales traffic_events_archive_YYYYMM)
+RETENTION_MODE = os.environ.get("RETENTION_MODE", "none")
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "1000"))
+# Compactar processed/ en paquetes diarios comprimidos
+COMPACT_PROCESSED = os.environ.get("COMPACT_PROCESSED", "true").lower() in ("1", "true", "yes")
+# Cada cuánto se ejecutan el archivado y la compactación
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", "3600"))
+
+# Aviso al servicio de caché de los eventos que cambiaron
+REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+EVENTS_CHANNEL = "events:changed"
+# Celdas y comunas con eventos nuevos, modificados o desaparecidos, para invalidar consultas por área
+AREAS_CHANNEL = "events:areas"
+# Tamaño en grados de las celdas de invalidación (debe coincidir con cache/app.py)
+QUERY_TILE_DEG = 0.02
+
+# Transporte desde el scraper: "file" (archivos en DATA_DIR) o "stream" (Redis Stream,
+# con los archivos como respaldo)
+EVENTS_TRANSPORT = os.environ.get("EVENTS_TRANSPORT", "file")
+EVENTS_STREAM = os.environ.get("EVENTS_STREAM", "events:ingest")
+STREAM_GROUP = "loaders"
+# Espera máxima de cada lectura bloqueante del stream
+STREAM_BLOCK_MS = int(os.environ.get("STREAM_BLOCK_MS", "5000"))
+# Entradas sin confirmar durante este tiempo se reasignan (réplica caída o lote fallido)
+STREAM_CLAIM_IDLE_MS = int(os.environ.get("STREAM_CLAIM_IDLE_MS", "60000"))
+
+# Directorios de trabajo
+DATA_DIR = os.environ.get("DATA_DIR", "/data")
+PROCESSED_DIR = os.path.join(DATA_DIR, "processed")
+# Paquetes diarios comprimidos de archivos procesados
+BUNDLES_DIR = os.path.join(PROCESSED_DIR, "bundles")
+# Archivos reclamados por cada réplica del loader (un subdirectorio por LOADER_ID)
+PROCESSING_DIR = os.path.join(DATA_DIR, "processing")
+# Archivos que no se pudieron procesar
+FAILED_DIR = os.path.join(DATA_DIR, "failed")
+# Debe ser estable entre reinicios (docker-compose lo fija) para retomar los archivos reclamados
+LOADER_ID = os.environ.get("LOADER_ID") or socket.gethostname()
+# Los directorios de reclamo de otras réplicas sin actividad durante este tiempo se recuperan
+CLAIM_STALE_SECONDS = int(os.environ.get("CLAIM_STALE_SECONDS", "900"))
+
+# Procesos que ingieren archivos en paralelo
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "4"))
+# Barrido completo del directorio como respaldo de las notificaciones del sistema de archivos
+POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "60"))
+# Intervalo de sondeo cuando no hay notificaciones disponibles
+FALLBACK_POLL_INTERVAL = int(os.environ.get("FALLBACK_POLL_INTERVAL", "5"))
+# Intentos de ingesta de un archivo antes de apartarlo en failed/, con espera exponencial
+# (INGEST_RETRY_BACKOFF, 2x, 4x, ... segundos) entre intentos
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", "5"))
+INGEST_RETRY_BACKOFF = float(os.environ.get("INGEST_RETRY_BACKOFF", "10"))
+
 # Conexión a MongoDB
 def get_mongo_client():
     """Establece conexión con MongoDB con reintentos"""
@@ -41,76 +144,954 @@ def initialize_db(client):
     
     # Crear índices para optimizar consultas
     collection.create_index('timestamp')
-    collection.create_index('type')
-    collection.create_index('location_desc')
     collection.create_index('uuid', unique=True) 
+    collection.create_index([('geo', GEOSPHERE)])
+    # Filtros frecuentes: tipo o comuna entre los eventos vistos en una ventana de tiempo
+    collection.create_index([('type', ASCENDING), ('last_seen', DESCENDING)])
+    collection.create_index([('location_desc', ASCENDING), ('last_seen', DESCENDING)])
+    
+    # Los índices simples de type y location_desc quedan cubiertos por los compuestos, y
+    # las consultas por área ya no filtran por timestamp
+    for redundant_index in ['type_1', 'location_desc_1', 'type_1_timestamp_-1', 'location_desc_1_timestamp_-1']:
+        try:
+            collection.drop_index(redundant_index)
+        except OperationFailure:
+            pass
+    
+    ensure_retention_index(collection)
+    
+    # Lecturas de agregados de una comuna (y tipo) en un rango de horas
+    db[ROLLUP_COLLECTION].create_index([('comuna', ASCENDING), ('type', ASCENDING), ('hour', ASCENDING)])
+    
+    # Las entradas del journal de ingesta expiran solas
+    db[JOURNAL_COLLECTION].create_index('updated_at', expireAfterSeconds=JOURNAL_TTL_SECONDS)
     
     logger.info("Base de datos e índices inicializados")
     return db, collection
 
+def ensure_retention_index(collection):
+    """
+    Crea el índice sobre last_seen: con expiración en modo "ttl", simple en los demás.
+    Si existe con otra configuración se reemplaza, para no borrar eventos en modo "archive".
+    La retención se basa en la última vez que el scraper vio el evento y no en
+    updated_at, que solo cambia con el contenido: un evento activo sin cambios no expira.
+    """
+    ttl = RETENTION_DAYS * 24 * 3600 if RETENTION_MODE == "ttl" else None
+    indexes = collection.index_information()
+    # Índice de retención anterior, sobre updated_at
+    if 'updated_at_1' in indexes:
+        collection.drop_index('updated_at_1')
+    existing = indexes.get('last_seen_1')
+    if existing and existing.get('expireAfterSeconds') != ttl:
+        collection.drop_index('last_seen_1')
+    if ttl:
+        collection.create_index('last_seen', expireAfterSeconds=ttl)
+    else:
+        collection.create_index('last_seen')
+
+def archive_old_events(db, collection):
+    """
+    Mueve los eventos que el scraper no ve hace más de RETENTION_DAYS a colecciones mensuales.
+    Primero se copian (idempotente por _id) y luego se borran de la colección principal.
+    Los documentos anteriores al campo last_seen se archivan una vez migrados (migrate_last_seen).
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=RETENTION_DAYS)
+    query = {"last_seen": {"$lt": cutoff}}
+    archived = 0
+    while True:
+        documents = list(collection.find(query).limit(ARCHIVE_BATCH_SIZE))
+        if not documents:
+            break
+        by_month = {}
+        for doc in documents:
+            by_month.setdefault(doc["last_seen"].strftime("%Y%m"), []).append(doc)
+        for month, docs in by_month.items():
+            db[f"traffic_events_archive_{month}"].bulk_write([
+                ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs
+            ], ordered=False)
+        collection.delete_many({"_id": {"$in": [doc["_id"] for doc in documents]}})
+        archived += len(documents)
+    if archived:
+        logger.info(f"Archivados {archived} eventos anteriores a {cutoff.date()}")
+    return archived
+
+def compact_processed_files():
+    """
+    Agrupa los archivos de processed/ de días anteriores en paquetes .tar.gz diarios.
+    """
+    if not os.path.isdir(PROCESSED_DIR):
+        return 0
+    today = datetime.datetime.now().strftime("%Y%m%d")
+    by_day = {}
+    for filename in os.listdir(PROCESSED_DIR):
+        match = re.match(r'events_(\d{8})\d*\.', filename)
+        if match and match.group(1) < today and is_event_file(filename):
+            by_day.setdefault(match.group(1), []).append(filename)
+
+    compacted = 0
+    for day, filenames in sorted(by_day.items()):
+        os.makedirs(BUNDLES_DIR, exist_ok=True)
+        # Si ya hay un paquete del día (archivos llegados tarde) se crea uno adicional
+        suffix = 0
+        bundle = os.path.join(BUNDLES_DIR, f"events_{day}.tar.gz")
+        while os.path.exists(bundle):
+            suffix += 1
+            bundle = os.path.join(BUNDLES_DIR, f"events_{day}-{suffix}.tar.gz")
+        tmp_bundle = os.path.join(BUNDLES_DIR, "." + os.path.basename(bundle))
+
+        added = []
+        with tarfile.open(tmp_bundle, "w:gz") as tar:
+            for filename in sorted(filenames):
+                try:
+                    tar.add(os.path.join(PROCESSED_DIR, filename), arcname=filename)
+                    added.append(filename)
+                except FileNotFoundError:
+                    pass
+        os.replace(tmp_bundle, bundle)
+        for filename in added:
+            os.remove(os.path.join(PROCESSED_DIR, filename))
+        compacted += len(added)
+        logger.info(f"Compactados {len(added)} archivos del {day} en {bundle}")
+    return compacted
+
+def start_maintenance(db, collection):
+    """Ejecuta periódicamente el archivado de eventos y la compactación de processed/"""
+    def run():
+        while True:
+            try:
+                if RETENTION_MODE == "archive":
+                    archive_old_events(db, collection)
+                if COMPACT_PROCESSED:
+                    compact_processed_files()
+            except Exception as e:
+                logger.error(f"Error en mantenimiento de retención: {e}")
+            time.sleep(MAINTENANCE_INTERVAL)
+    threading.Thread(target=run, daemon=True).start()
+
+def location_to_geo(location):
+    """
+    Convierte una ubicación "lat,lon" en un punto GeoJSON.
+    Devuelve None si la ubicación no es válida, para no romper el índice 2dsphere.
+    """
+    try:
+        lat, lon = (float(part) for part in location.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+def migrate_geo(collection, batch_size=GEO_MIGRATION_BATCH_SIZE, pause=GEO_MIGRATION_PAUSE):
+    """
+    Agrega el campo geo a los documentos existentes que no lo tienen.
+    Avanza en lotes por _id con pausas entre lotes para no competir con la ingesta.
+    """
+    query = {"geo": {"$exists": False}}
+    last_id = None
+    migrated = 0
+    while True:
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        documents = list(collection.find(query, {"location": 1}).sort("_id", ASCENDING).limit(batch_size))
+        if not documents:
+            break
+        collection.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"geo": location_to_geo(doc.get("location"))}})
+            for doc in documents
+        ], ordered=False)
+        migrated += len(documents)
+        last_id = documents[-1]["_id"]
+        time.sleep(pause)
+    if migrated:
+        logger.info(f"Migración geo completada: {migrated} documentos actualizados")
+    return migrated
+
+def legacy_last_seen(doc):
+    """last_seen inicial de un documento anterior al campo: updated_at, o processed_at, o ahora"""
+    if isinstance(doc.get("updated_at"), datetime.datetime):
+        return doc["updated_at"]
+    try:
+        # processed_at es hora local en formato ISO
+        return datetime.datetime.utcfromtimestamp(datetime.datetime.fromisoformat(doc["processed_at"]).timestamp())
+    except (KeyError, TypeError, ValueError):
+        return datetime.datetime.utcnow()
+
+def migrate_last_seen(collection, batch_size=GEO_MIGRATION_BATCH_SIZE, pause=GEO_MIGRATION_PAUSE):
+    """
+    Agrega last_seen a los documentos existentes que no lo tienen, una sola vez y en
+    lotes por _id, para que la retención use solo el índice de last_seen.
+    """
+    query = {"last_seen": {"$exists": False}}
+    last_id = None
+    migrated = 0
+    while True:
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        documents = list(collection.find(query, {"updated_at": 1, "processed_at": 1})
+                         .sort("_id", ASCENDING).limit(batch_size))
+        if not documents:
+            break
+        collection.bulk_write([
+            UpdateOne({"_id": doc["_id"], "last_seen": {"$exists": False}},
+                      {"$set": {"last_seen": legacy_last_seen(doc)}})
+            for doc in documents
+        ], ordered=False)
+        migrated += len(documents)
+        last_id = documents[-1]["_id"]
+        time.sleep(pause)
+    if migrated:
+        logger.info(f"Migración de last_seen completada: {migrated} documentos actualizados")
+    return migrated
+
+def start_migrations(collection):
+    """Ejecuta las migraciones geo y de last_seen en un hilo para no bloquear la ingesta"""
+    def run():
+        try:
+            migrate_geo(collection)
+        except Exception as e:
+            logger.error(f"Error en migración geo: {e}")
+        try:
+            migrate_last_seen(collection)
+        except Exception as e:
+            logger.error(f"Error en migración de last_seen: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
+def content_hash(event):
+    """Hash estable de los campos significativos de un evento"""
+    content = {k: v for k, v in event.items() if k not in VOLATILE_FIELDS}
+    encoded = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+def stored_states(collection, events):
+    """
+    Estado guardado en MongoDB de los eventos de un lote (uuid -> documento con su
+    content_hash, timestamp, expired_at y last_seen), leído con una sola consulta por el índice de uuid. Al comparar con
+    MongoDB y no con memoria local, todos los procesos y réplicas ven el mismo estado.
+    """
+    uuids = list({event["uuid"] for event in events})
+    return {
+        doc["uuid"]: doc
+        for doc in collection.find({"uuid": {"$in": uuids}}, {"_id": 0, "uuid": 1, "content_hash": 1, "timestamp": 1,
+                                                                  "expired_at": 1, "last_seen": 1})
+    }
+
+def is_unchanged(event, stored):
+    """
+    Indica si el evento ya está guardado con el mismo contenido. Un evento marcado
+    como desaparecido que reaparece se escribe siempre, para quitarle expired_at.
+    """
+    return (stored is not None and "expired_at" not in stored
+            and stored.get("content_hash") == event.get("content_hash"))
+
+def is_stale(event, stored):
+    """
+    Indica si MongoDB ya tiene una versión posterior del evento (timestamp mayor) o un
+    marcador de desaparición posterior a él. Pasa cuando los workers de ingesta procesan
+    archivos del backlog fuera de orden.
+    """
+    timestamp = event.get("timestamp")
+    if stored is None or not timestamp:
+        return False
+    return (stored.get("timestamp") or "") > timestamp or (stored.get("expired_at") or "") > timestamp
+
+def not_newer_filter(uuid, timestamp):
+    """
+    Filtro del documento de un uuid que solo coincide si lo guardado no es posterior a
+    timestamp. Con upsert, si el documento existe pero es posterior, la inserción falla
+    por el índice único de uuid (DUPLICATE_KEY_ERROR) y el evento se descarta.
+    """
+    if not timestamp:
+        return {"uuid": uuid}
+    return {"uuid": uuid, "$and": [
+        {"$or": [{"timestamp": {"$exists": False}}, {"timestamp": {"$lte": timestamp}}]},
+        {"$or": [{"expired_at": {"$exists": False}}, {"expired_at": {"$lte": timestamp}}]},
+    ]}
+
+def rollup_key(event):
+    """Clave del agregado de un evento: (comuna, tipo, hora "YYYY-MM-DDTHH:00")"""
+    hour = f"{str(event.get('timestamp', ''))[:13]}:00"
+    return event.get("location_desc", "Desconocido"), event.get("type", "unknown"), hour
+
+def update_rollups(db, events):
+    """
+    Suma los eventos recién insertados a los agregados por comuna, tipo y hora.
+    Se acumula primero en memoria para enviar un único $inc por clave.
+    """
+    increments = {}
+    for event in events:
+        key = rollup_key(event)
+        inc = increments.setdefault(key, {"count": 0})
+        inc["count"] += 1
+        if event.get("type") == "traffic_jam":
+            inc["jam_count"] = inc.get("jam_count", 0) + 1
+            inc["speed_sum"] = inc.get("speed_sum", 0) + (event.get("speed") or 0)
+            # delay_seconds = -1 indica que Waze no informó el retraso
+            delay = event.get("delay_seconds")
+            if isinstance(delay, (int, float)) and delay >= 0:
+                inc["delay_count"] = inc.get("delay_count", 0) + 1
+                inc["delay_sum"] = inc.get("delay_sum", 0) + delay
+
+    if not increments:
+        return
+    db[ROLLUP_COLLECTION].bulk_write([
+        UpdateOne(
+            {"_id": "|".join(key)},
+            {"$inc": inc, "$setOnInsert": {"comuna": key[0], "type": key[1], "hour": key[2]}},
+            upsert=True
+        )
+        for key, inc in increments.items()
+    ], ordered=False)
+
+def rebuild_rollups(db):
+    """
+    Recalcula todos los agregados desde traffic_events.
+    Se generan en una colección temporal que luego reemplaza a la actual.
+    """
+    start_time = time.time()
+    tmp_collection = f"{ROLLUP_COLLECTION}_rebuild"
+    hour = {"$concat": [{"$substrCP": ["$timestamp", 0, 13]}, ":00"]}
+    is_jam = {"$eq": ["$type", "traffic_jam"]}
+    has_delay = {"$and": [is_jam, {"$gte": ["$delay_seconds", 0]}]}
+    db['traffic_events'].aggregate([
+        {"$group": {
+            "_id": {"comuna": {"$ifNull": ["$location_desc", "Desconocido"]},
+                    "type": {"$ifNull": ["$type", "unknown"]},
+                    "hour": hour},
+            "count": {"$sum": 1},
+            "jam_count": {"$sum": {"$cond": [is_jam, 1, 0]}},
+            "speed_sum": {"$sum": {"$cond": [is_jam, {"$ifNull": ["$speed", 0]}, 0]}},
+            "delay_count": {"$sum": {"$cond": [has_delay, 1, 0]}},
+            "delay_sum": {"$sum": {"$cond": [has_delay, "$delay_seconds", 0]}}
+        }},
+        {"$project": {
+            "_id": {"$concat": ["$_id.comuna", "|", "$_id.type", "|", "$_id.hour"]},
+            "comuna": "$_id.comuna", "type": "$_id.type", "hour": "$_id.hour",
+            "count": 1, "jam_count": 1, "speed_sum": 1, "delay_count": 1, "delay_sum": 1
+        }},
+        {"$out": tmp_collection}
+    ], allowDiskUse=True)
+    db[tmp_collection].create_index([('comuna', ASCENDING), ('type', ASCENDING), ('hour', ASCENDING)])
+    db[tmp_collection].rename(ROLLUP_COLLECTION, dropTarget=True)
+    count = db[ROLLUP_COLLECTION].count_documents({})
+    logger.info(f"Agregados reconstruidos: {count} documentos en {time.time() - start_time:.1f}s")
+    return count
+
+# Cliente Redis de cada proceso, creado al primer uso
+redis_client = None
+
+def publish_changed_events(uuids):
+    """
+    Publica los uuids de eventos actualizados para que la caché los refresque o invalide.
+    Un fallo de Redis no interrumpe la ingesta: la caché expira igual por TTL.
+    """
+    global redis_client
+    if not uuids:
+        return
+    try:
+        if redis_client is None:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        redis_client.publish(EVENTS_CHANNEL, json.dumps(uuids))
+    except Exception as e:
+        logger.error(f"Error publicando eventos actualizados: {e}")
+
+def publish_changed_areas(events):
+    """Publica las celdas y comunas de eventos escritos para que la caché invalide sus consultas"""
+    global redis_client
+    tiles, comunas = set(), set()
+    for event in events:
+        geo = event.get("geo")
+        if geo:
+            lon, lat = geo["coordinates"]
+            tiles.add(f"{math.floor(lat / QUERY_TILE_DEG)}:{math.floor(lon / QUERY_TILE_DEG)}")
+        if event.get("location_desc"):
+            comunas.add(event["location_desc"])
+    if not tiles and not comunas:
+        return
+    try:
+        if redis_client is None:
+            redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+        redis_client.publish(AREAS_CHANNEL, json.dumps({"tiles": sorted(tiles), "comunas": sorted(comunas)}))
+    except Exception as e:
+        logger.error(f"Error publicando áreas actualizadas: {e}")
+
+def touch_last_seen(collection, events, stored):
+    """
+    Actualiza solo last_seen de eventos re-emitidos sin cambios, si el valor guardado
+    tiene más de LAST_SEEN_RESOLUTION segundos. Así las consultas por ventana de tiempo
+    siguen viendo los eventos activos sin reescribir el documento completo.
+    """
+    operations = []
+    for event in events:
+        last_seen = stored[event["uuid"]].get("last_seen")
+        if last_seen is None or (event["last_seen"] - last_seen).total_seconds() >= LAST_SEEN_RESOLUTION:
+            operations.append(UpdateOne({"uuid": event["uuid"]}, {"$max": {"last_seen": event["last_seen"]}}))
+    if not operations:
+        return
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        logger.error(f"Error actualizando last_seen de {len(e.details.get('writeErrors', []))} eventos")
+
+def write_batch(collection, events):
+    """
+    Envía un lote de upserts en un único bulk_write no ordenado, omitiendo los eventos
+    cuyo contenido ya está guardado igual en MongoDB.
+    Los errores de documentos individuales se registran sin abortar el resto del lote.
+    Los eventos nuevos se suman a los agregados por comuna, tipo y hora, y los
+    actualizados se publican para la caché.
+    Un evento solo se escribe si lo guardado no es posterior a su timestamp, porque los
+    workers procesan los archivos del backlog en cualquier orden.
+    Devuelve la cantidad de eventos escritos correctamente y la de omitidos (sin cambios
+    o anteriores a lo guardado).
+    """
+    if not events:
+        return 0, 0
+
+    # Omitir eventos que el scraper re-emitió sin cambios (solo se actualiza last_seen)
+    # y los de archivos anteriores a lo ya guardado
+    stored = stored_states(collection, events)
+    changed, unchanged, stale = [], [], 0
+    for event in events:
+        if is_stale(event, stored.get(event["uuid"])):
+            stale += 1
+        elif is_unchanged(event, stored.get(event["uuid"])):
+            unchanged.append(event)
+        else:
+            changed.append(event)
+    touch_last_seen(collection, unchanged, stored)
+    events = changed
+    skipped = len(unchanged) + stale
+    if not events:
+        return 0, skipped
+
+    # Un evento reemitido deja de estar marcado como desaparecido. El filtro vuelve a
+    # comprobar el timestamp por si otro worker escribió una versión posterior entretanto
+    operations = [
+        UpdateOne(not_newer_filter(event["uuid"], event.get("timestamp")),
+                  {"$set": event, "$unset": {"expired_at": ""}}, upsert=True)
+        for event in events
+    ]
+    failed = set()
+    try:
+        upserted = collection.bulk_write(operations, ordered=False).upserted_ids.keys()
+    except BulkWriteError as e:
+        upserted = [u["index"] for u in e.details.get("upserted", [])]
+        write_errors = e.details.get("writeErrors", [])
+        for error in write_errors:
+            failed.add(error["index"])
+            if error.get("code") == DUPLICATE_KEY_ERROR:
+                skipped += 1
+                continue
+            failed_uuid = events[error["index"]].get("uuid")
+            logger.error(f"Error procesando evento {failed_uuid}: {error.get('errmsg')}")
+
+    # Solo los eventos insertados cuentan en los agregados (las actualizaciones ya estaban)
+    try:
+        update_rollups(collection.database, [events[i] for i in upserted])
+    except Exception as e:
+        logger.error(f"Error actualizando agregados: {e}")
+
+    # Los eventos insertados no pueden estar en la caché; los actualizados sí
+    upserted = set(upserted)
+    publish_changed_events([
+        event["uuid"] for i, event in enumerate(events) if i not in failed and i not in upserted
+    ])
+    publish_changed_areas([event for i, event in enumerate(events) if i not in failed])
+    return len(operations) - len(failed), skipped
+
+def expire_events(collection, markers):
+    """
+    Marca como desaparecidos los eventos que el scraper dejó de ver, con $set de
+    expired_at y sin upsert (un marcador nunca crea un documento). Un marcador anterior
+    al timestamp guardado no se aplica (el evento reapareció después). Se publican para
+    que la caché los refresque o invalide.
+    Devuelve la cantidad de eventos marcados.
+    """
+    if not markers:
+        return 0
+
+    operations = []
+    for marker in markers:
+        expired_at = marker.get("expired_at", datetime.datetime.now().isoformat())
+        operations.append(UpdateOne(
+            {"uuid": marker["uuid"], "$or": [{"timestamp": {"$exists": False}}, {"timestamp": {"$lte": expired_at}}]},
+            {"$set": {"expired_at": expired_at}}))
+    try:
+        modified = collection.bulk_write(operations, ordered=False).matched_count
+    except BulkWriteError as e:
+        modified = e.details.get("nMatched", 0)
+        for error in e.details.get("writeErrors", []):
+            logger.error(f"Error marcando evento {markers[error['index']]['uuid']} como desaparecido: {error.get('errmsg')}")
+
+    uuids = [marker["uuid"] for marker in markers]
+    publish_changed_events(uuids)
+    try:
+        publish_changed_areas(collection.find({"uuid": {"$in": uuids}}, {"geo": 1, "location_desc": 1}))
+    except Exception as e:
+        logger.error(f"Error obteniendo áreas de eventos desaparecidos: {e}")
+    return modified
+
+def is_valid_record(record):
+    """Un registro válido es un objeto JSON con uuid (evento o marcador de desaparición)"""
+    return isinstance(record, dict) and isinstance(record.get("uuid"), str) and bool(record["uuid"])
+
+def prepare_event(event, processed_at, updated_at):
+    """
+    Completa un evento antes de escribirlo (punto geo, hash de contenido y fechas de procesamiento).
+    updated_at marca el último cambio de contenido y last_seen la última vez que el scraper lo vio.
+    """
+    event['geo'] = location_to_geo(event.get('location'))
+    event['content_hash'] = content_hash(event)
+    event['processed_at'] = processed_at
+    event['updated_at'] = updated_at
+    event['last_seen'] = updated_at
+
+def open_event_file(filepath):
+    """Abre un archivo de eventos en modo texto, descomprimiendo si termina en .gz"""
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rt', encoding='utf-8')
+    return open(filepath, 'r', encoding='utf-8')
+
+def iter_json_array(f):
+    """
+    Recorre un arreglo JSON elemento por elemento sin cargar el archivo completo.
+    La memoria usada queda acotada por el tamaño del elemento más grande.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(READ_CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise json.JSONDecodeError("Se esperaba un arreglo JSON", buffer, 0)
+    pos = 1
+    eof = False
+
+    while True:
+        # Saltar espacios y separadores entre elementos
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos >= len(buffer) and eof:
+            raise json.JSONDecodeError("Arreglo JSON incompleto", buffer, pos)
+
+        try:
+            if pos >= len(buffer):
+                raise ValueError("buffer vacío")
+            event, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if eof:
+                raise
+            # El elemento está incompleto: descartar lo ya consumido y leer más
+            chunk = f.read(READ_CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        yield event
+        pos = end
+
+def iter_events(filepath):
+    """Recorre los eventos de un archivo, sea un arreglo JSON o JSON por línea"""
+    with open_event_file(filepath) as f:
+        # Detectar el formato por el primer carácter significativo
+        first = ''
+        while True:
+            first = f.read(1)
+            if not first or not first.isspace():
+                break
+        f.seek(0)
+
+        if first == '[':
+            yield from iter_json_array(f)
+            return
+
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"Línea {line_number} inválida en {filepath}: {e}")
+
+def get_journal_entry(journal, filepath):
+    """
+    Devuelve el avance registrado para un archivo, o None si no hay.
+    Se descarta si el archivo cambió de tamaño desde que se registró.
+    """
+    entry = journal.find_one({"_id": os.path.basename(filepath)})
+    if entry and entry.get("size") != os.path.getsize(filepath):
+        logger.warning(f"El archivo {filepath} cambió desde la última ingesta, se procesará completo")
+        return None
+    return entry
+
+def record_progress(journal, filepath, records, batches, completed=False):
+    """Registra cuántos registros y lotes de un archivo quedaron confirmados en MongoDB"""
+    journal.update_one(
+        {"_id": os.path.basename(filepath)},
+        {"$set": {
+            "size": os.path.getsize(filepath),
+            "records": records,
+            "batches": batches,
+            "completed": completed,
+            "updated_at": datetime.datetime.utcnow()
+        }},
+        upsert=True
+    )
+
+def move_to_processed(filepath):
+    """Mueve un archivo ya ingerido a la carpeta de procesados"""
+    os.makedirs(PROCESSED_DIR, exist_ok=True)
+    
+    processed_filepath = os.path.join(
+        PROCESSED_DIR, 
+        os.path.basename(filepath)
+    )
+    
+    shutil.move(filepath, processed_filepath)
+    logger.info(f"Archivo movido a {processed_filepath}")
+
+def move_to_failed(filepath):
+    """Aparta un archivo que no se puede procesar para no reintentarlo indefinidamente"""
+    os.makedirs(FAILED_DIR, exist_ok=True)
+    shutil.move(filepath, os.path.join(FAILED_DIR, os.path.basename(filepath)))
+    logger.warning(f"Archivo {os.path.basename(filepath)} movido a {FAILED_DIR}")
+
 def process_file(filepath, collection):
-    """Procesa un archivo JSON y carga sus eventos en MongoDB"""
+    """
+    Procesa un archivo de eventos y los carga en MongoDB en lotes.
+    El avance se registra en el journal después de cada lote, de modo que tras un
+    reinicio se retoma desde el último lote confirmado.
+    """
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            events = json.load(f)
-            
-        if not events:
-            logger.warning(f"Archivo vacío o con formato incorrecto: {filepath}")
+        start_time = time.time()
+        # Timestamp de procesamiento común a todos los eventos del archivo
+        processed_at = datetime.datetime.now().isoformat()
+        # Fecha BSON usada por la retención (TTL o archivado)
+        updated_at = datetime.datetime.utcnow()
+        
+        journal = collection.database[JOURNAL_COLLECTION]
+        entry = get_journal_entry(journal, filepath)
+        if entry and entry.get("completed"):
+            logger.info(f"Archivo {filepath} ya ingerido por completo")
+            move_to_processed(filepath)
             return 0
         
-        # Añadir timestamp de procesamiento
-        processed_events = []
-        for event in events:
-            event['processed_at'] = datetime.datetime.now().isoformat()
-            processed_events.append(event)
+        # Registros ya confirmados en una ejecución anterior
+        resume_from = entry["records"] if entry else 0
+        batches = entry["batches"] if entry else 0
+        if resume_from:
+            logger.info(f"Reanudando {filepath} desde el registro {resume_from} (lote {batches})")
         
         # Contador para eventos procesados correctamente
         successful_events = 0
+        total_events = 0
+        skipped_events = 0
+        expired_events = 0
+        invalid_events = 0
         
-        # Procesar eventos uno por uno para manejar duplicados
-        for event in processed_events:
-            try:
-                # Intentar upsert (actualizar si existe, insertar si no)
-                result = collection.update_one(
-                    {"uuid": event["uuid"]},  
-                    {"$set": event},          
-                    upsert=True             
-                )
-                successful_events += 1
-            except Exception as e:
-                logger.error(f"Error procesando evento: {e}")
+        # Upserts en lotes (actualizar si existe, insertar si no)
+        batch = []
+        expired = []
+        for event in iter_events(filepath):
+            total_events += 1
+            if total_events <= resume_from:
+                continue
+            # Un registro malformado se omite sin detener el resto del archivo
+            if not is_valid_record(event):
+                invalid_events += 1
+                logger.error(f"Registro {total_events} inválido en {filepath}, se omite: {str(event)[:200]}")
+                continue
+            # Marcadores de eventos desaparecidos emitidos por el scraper en modo delta
+            if event.get('expired'):
+                expired.append(event)
+                continue
+            prepare_event(event, processed_at, updated_at)
+            batch.append(event)
+            if len(batch) >= INGEST_BATCH_SIZE:
+                # Los marcadores previos al corte se aplican antes de confirmar el avance
+                expired_events += expire_events(collection, expired)
+                expired = []
+                written, skipped = write_batch(collection, batch)
+                successful_events += written
+                skipped_events += skipped
+                batch = []
+                batches += 1
+                record_progress(journal, filepath, total_events, batches)
+            
+        if total_events == 0:
+            logger.warning(f"Archivo vacío o con formato incorrecto: {filepath}")
+            move_to_failed(filepath)
+            return 0
         
-        # Mover archivo a carpeta de procesados
-        processed_dir = os.path.join(os.path.dirname(filepath), "processed")
-        os.makedirs(processed_dir, exist_ok=True)
+        if batch:
+            written, skipped = write_batch(collection, batch)
+            successful_events += written
+            skipped_events += skipped
+            batches += 1
+        expired_events += expire_events(collection, expired)
+        record_progress(journal, filepath, total_events, batches, completed=True)
         
-        processed_filepath = os.path.join(
-            processed_dir, 
-            os.path.basename(filepath)
-        )
-        
-        shutil.move(filepath, processed_filepath)
-        logger.info(f"Archivo movido a {processed_filepath}")
+        # Mover archivo a carpeta de procesados
+        move_to_processed(filepath)
         
-        logger.info(f"Total de {successful_events} eventos insertados o actualizados en este ciclo")
+        elapsed = time.time() - start_time
+        rate = successful_events / elapsed if elapsed > 0 else 0
+        logger.info(f"Total de {successful_events} eventos insertados o actualizados en este ciclo "
+                    f"({elapsed:.2f}s, {rate:.0f} eventos/s)")
+        if expired_events:
+            logger.info(f"Marcados {expired_events} eventos como desaparecidos")
+        if skipped_events:
+            logger.info(f"Omitidas {skipped_events} de {total_events} escrituras de eventos sin cambios o anteriores a lo guardado")
+        if invalid_events:
+            logger.warning(f"Omitidos {invalid_events} registros inválidos de {filepath}")
         return successful_events
         
     except json.JSONDecodeError:
         logger.error(f"Error decodificando JSON en {filepath}")
+        move_to_failed(filepath)
         return 0
     except Exception as e:
+        # El archivo queda en su lugar para reintentarlo desde el último lote confirmado
         logger.error(f"Error procesando archivo {filepath}: {e}")
         return 0
 
+def ingest_stream_entries(collection, entries):
+    """
+    Escribe un lote de entradas del stream. Las entradas ilegibles se descartan con
+    un error en el log; un fallo de MongoDB se propaga para no confirmar el lote.
+    Devuelve la cantidad de eventos escritos.
+    """
+    processed_at = datetime.datetime.now().isoformat()
+    updated_at = datetime.datetime.utcnow()
+    batch = []
+    expired = []
+    for entry_id, fields in entries:
+        try:
+            event = json.loads(fields["event"])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Entrada {entry_id} del stream ilegible, se descarta: {e}")
+            continue
+        if not is_valid_record(event):
+            logger.error(f"Entrada {entry_id} del stream inválida, se descarta: {str(event)[:200]}")
+            continue
+        if event.get('expired'):
+            expired.append(event)
+        else:
+            prepare_event(event, processed_at, updated_at)
+            batch.append(event)
+    written, _ = write_batch(collection, batch)
+    expire_events(collection, expired)
+    return written
+
+def consume_stream(collection):
+    """
+    Consume el stream de eventos del scraper con un grupo de consumidores.
+    Cada lote se confirma (XACK) y se borra del stream solo después de escribirse, de
+    modo que el largo del stream es el trabajo pendiente que el scraper usa como
+    contrapresión. Al iniciar se reprocesan las entradas propias sin confirmar, y las
+    de otras réplicas inactivas más de STREAM_CLAIM_IDLE_MS se reclaman con XAUTOCLAIM.
+    """
+    client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+    # "0" lee primero las entradas pendientes de este consumidor; luego solo las nuevas
+    read_id = "0"
+    claim_cursor = "0-0"
+    next_claim = 0
+    group_ready = False
+    while True:
+        try:
+            if not group_ready:
+                try:
+                    client.xgroup_create(EVENTS_STREAM, STREAM_GROUP, id="0", mkstream=True)
+                except redis.ResponseError as e:
+                    if "BUSYGROUP" not in str(e):
+                        raise
+                group_ready = True
+                logger.info(f"Consumiendo el stream {EVENTS_STREAM} como {LOADER_ID}")
+
+            entries = []
+            if time.time() >= next_claim:
+                claim_cursor, entries = client.xautoclaim(
+                    EVENTS_STREAM, STREAM_GROUP, LOADER_ID, STREAM_CLAIM_IDLE_MS,
+                    start_id=claim_cursor, count=INGEST_BATCH_SIZE)[:2]
+                if claim_cursor == "0-0":
+                    next_claim = time.time() + STREAM_CLAIM_IDLE_MS / 1000
+                if entries:
+                    logger.warning(f"Reclamadas {len(entries)} entradas sin confirmar del stream")
+
+            if not entries:
+                response = client.xreadgroup(STREAM_GROUP, LOADER_ID, {EVENTS_STREAM: read_id},
+                                             count=INGEST_BATCH_SIZE, block=STREAM_BLOCK_MS)
+                entries = response[0][1] if response else []
+                if read_id == "0" and not entries:
+                    read_id = ">"
+                    continue
+            if not entries:
+                continue
+
+            start_time = time.time()
+            written = ingest_stream_entries(collection, entries)
+            entry_ids = [entry_id for entry_id, _ in entries]
+            client.xack(EVENTS_STREAM, STREAM_GROUP, *entry_ids)
+            client.xdel(EVENTS_STREAM, *entry_ids)
+            logger.info(f"Stream: {len(entries)} entradas, {written} eventos escritos "
+                        f"({time.time() - start_time:.2f}s)")
+        except Exception as e:
+            # Las entradas sin confirmar se vuelven a leer al reclamarlas
+            logger.error(f"Error consumiendo el stream {EVENTS_STREAM}: {e}")
+            group_ready = False
+            time.sleep(5)
+
+def start_stream_consumer(collection):
+    """Inicia el consumo del stream en un hilo del proceso principal"""
+    threading.Thread(target=consume_stream, args=(collection,), daemon=True).start()
+
 def check_event_count(collection):
     """Verifica el número total de eventos en la base de datos"""
     count = collection.count_documents({})
     logger.info(f"Total de eventos almacenados: {count}")
     return count
 
+def is_event_file(filename):
+    """Indica si un nombre de archivo corresponde a un archivo de eventos listo para procesar"""
+    return filename.endswith(EVENT_FILE_SUFFIXES) and not filename.startswith('.')
+
+def list_event_files(data_dir):
+    """Lista los archivos de eventos pendientes en el directorio de datos"""
+    return [os.path.join(data_dir, f) for f in sorted(os.listdir(data_dir))
+            if is_event_file(f) and os.path.isfile(os.path.join(data_dir, f))]
+
+def claim_file(filepath):
+    """
+    Reclama un archivo moviéndolo al directorio de trabajo de esta réplica.
+    El rename es atómico: si otra réplica lo reclamó antes, devuelve None.
+    """
+    claim_dir = os.path.join(PROCESSING_DIR, LOADER_ID)
+    os.makedirs(claim_dir, exist_ok=True)
+    claimed_path = os.path.join(claim_dir, os.path.basename(filepath))
+    try:
+        os.rename(filepath, claimed_path)
+        return claimed_path
+    except FileNotFoundError:
+        return None
+
+def recover_claimed_files():
+    """Devuelve los archivos que esta réplica había reclamado antes de reiniciarse"""
+    claim_dir = os.path.join(PROCESSING_DIR, LOADER_ID)
+    if not os.path.isdir(claim_dir):
+        return []
+    claimed = list_event_files(claim_dir)
+    if claimed:
+        logger.info(f"Recuperados {len(claimed)} archivos reclamados antes de reiniciar")
+    return claimed
+
+def touch_claim_dir():
+    """Marca el directorio de reclamo de esta réplica como activo (latido para las demás)"""
+    claim_dir = os.path.join(PROCESSING_DIR, LOADER_ID)
+    os.makedirs(claim_dir, exist_ok=True)
+    os.utime(claim_dir)
+
+def take_over_stale_claims():
+    """
+    Reclama los archivos de directorios de otras réplicas (o de un LOADER_ID anterior)
+    sin latido hace más de CLAIM_STALE_SECONDS. Cada archivo se mueve con un rename
+    atómico, así que si dos réplicas lo intentan a la vez solo una lo obtiene.
+    """
+    if not os.path.isdir(PROCESSING_DIR):
+        return []
+    taken = []
+    now = time.time()
+    for owner in os.listdir(PROCESSING_DIR):
+        stale_dir = os.path.join(PROCESSING_DIR, owner)
+        try:
+            if owner == LOADER_ID or now - os.path.getmtime(stale_dir) < CLAIM_STALE_SECONDS:
+                continue
+            filenames = list_event_files(stale_dir)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        recovered = [path for path in map(claim_file, filenames) if path]
+        try:
+            os.rmdir(stale_dir)
+        except OSError:
+            pass
+        if recovered:
+            logger.warning(f"Recuperados {len(recovered)} archivos del directorio inactivo de {owner}")
+        taken.extend(recovered)
+    return taken
+
+class EventFileHandler(FileSystemEventHandler):
+    """Encola los archivos de eventos que aparecen en el directorio de datos"""
+
+    def __init__(self, pending):
+        self.pending = pending
+
+    def on_created(self, event):
+        self.enqueue(event.src_path, event.is_directory)
+
+    def on_moved(self, event):
+        # El scraper escribe un archivo oculto y luego lo renombra
+        self.enqueue(event.dest_path, event.is_directory)
+
+    def enqueue(self, path, is_directory):
+        if (not is_directory and os.path.normpath(os.path.dirname(path)) == os.path.normpath(DATA_DIR)
+                and is_event_file(os.path.basename(path))):
+            self.pending.put(path)
+
+def start_watcher(data_dir, pending):
+    """Inicia las notificaciones del sistema de archivos (inotify en Linux); None si no están disponibles"""
+    if Observer is None:
+        logger.warning("watchdog no está instalado, se usará sondeo periódico")
+        return None
+    try:
+        observer = Observer()
+        observer.schedule(EventFileHandler(pending), data_dir, recursive=False)
+        observer.start()
+        logger.info(f"Observando {data_dir} con {type(observer).__name__}")
+        return observer
+    except Exception as e:
+        logger.warning(f"No se pudo iniciar el observador de archivos, se usará sondeo periódico: {e}")
+        return None
+
+# Colección usada por cada proceso del pool de ingesta
+worker_collection = None
+
+def init_ingest_worker():
+    """Abre una conexión a MongoDB propia en cada proceso del pool"""
+    global worker_collection
+    client = get_mongo_client()
+    worker_collection = client['traffic_db']['traffic_events']
+
+def ingest_claimed_file(claimed_path):
+    """Procesa un archivo reclamado con la conexión del proceso"""
+    return process_file(claimed_path, worker_collection)
+
+def new_ingest_pool():
+    return ProcessPoolExecutor(max_workers=INGEST_WORKERS, initializer=init_ingest_worker)
+
+def schedule_retry(claimed_path, attempts, retry_at):
+    """
+    Registra un intento fallido de un archivo. Devuelve True si debe reintentarse (con
+    espera exponencial en retry_at) o False si se apartó en failed/ tras INGEST_MAX_ATTEMPTS.
+    """
+    attempts[claimed_path] = attempts.get(claimed_path, 0) + 1
+    if attempts[claimed_path] >= INGEST_MAX_ATTEMPTS:
+        logger.error(f"{os.path.basename(claimed_path)} falló {attempts[claimed_path]} veces, se aparta")
+        attempts.pop(claimed_path)
+        retry_at.pop(claimed_path, None)
+        try:
+            move_to_failed(claimed_path)
+        except OSError as e:
+            logger.error(f"No se pudo apartar {claimed_path}: {e}")
+        return False
+    delay = INGEST_RETRY_BACKOFF * 2 ** (attempts[claimed_path] - 1)
+    retry_at[claimed_path] = time.time() + delay
+    logger.warning(f"Se reintentará {os.path.basename(claimed_path)} en {delay:.0f}s "
+                   f"(intento {attempts[claimed_path]} de {INGEST_MAX_ATTEMPTS})")
+    return True
+
 def main():
     """Función principal del cargador de datos"""
-    logger.info("Iniciando servicio de carga de datos")
+    logger.info(f"Iniciando servicio de carga de datos (réplica {LOADER_ID}, {INGEST_WORKERS} procesos)")
     
     # Esperar a que MongoDB esté disponible
     time.sleep(10)
@@ -118,25 +1099,88 @@ def main():
     # Inicializar conexión y base de datos
     client = get_mongo_client()
     db, collection = initialize_db(client)
+    start_migrations(collection)
+    start_maintenance(db, collection)
+    if EVENTS_TRANSPORT == "stream":
+        start_stream_consumer(collection)
+    
+    pending = queue.Queue()
+    observer = start_watcher(DATA_DIR, pending)
+    scan_interval = POLL_INTERVAL if observer else FALLBACK_POLL_INTERVAL
+    next_scan = 0
+    
+    pool = new_ingest_pool()
+    in_flight = {}
+    # Archivos ya reclamados pendientes de enviarse al pool
+    claimed = recover_claimed_files()
+    touch_claim_dir()
+    # Intentos fallidos por archivo y momento a partir del cual se puede reintentar
+    attempts = {}
+    retry_at = {}
+    total_inserted = 0
     
     while True:
         try:
-            # Buscar archivos JSON nuevos en el directorio de datos
-            data_dir = "/data"
-            files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) 
-                    if f.endswith('.json') and os.path.isfile(os.path.join(data_dir, f))
-                    and not f.startswith('.')]
+            # Barrido periódico: archivos existentes al iniciar y notificaciones perdidas
+            if time.time() >= next_scan:
+                for filepath in list_event_files(DATA_DIR):
+                    pending.put(filepath)
+                touch_claim_dir()
+                claimed.extend(take_over_stale_claims())
+                next_scan = time.time() + scan_interval
             
-            if files:
-                logger.info(f"Encontrados {len(files)} archivos para procesar")
-                total_inserted = 0
-                
-                for filepath in files:
-                    inserted = process_file(filepath, collection)
-                    total_inserted += inserted
-                
+            # Reclamar archivos nuevos solo si hay procesos libres (los que esperan reintento no cuentan)
+            now = time.time()
+            ready = [path for path in claimed if retry_at.get(path, 0) <= now]
+            while len(in_flight) + len(ready) < INGEST_WORKERS:
+                try:
+                    filepath = pending.get_nowait()
+                except queue.Empty:
+                    break
+                claimed_path = claim_file(filepath)
+                if claimed_path:
+                    claimed.append(claimed_path)
+                    ready.append(claimed_path)
+            
+            while ready and len(in_flight) < INGEST_WORKERS:
+                claimed_path = ready.pop(0)
+                claimed.remove(claimed_path)
+                retry_at.pop(claimed_path, None)
+                logger.info(f"Procesando {os.path.basename(claimed_path)}")
+                in_flight[pool.submit(ingest_claimed_file, claimed_path)] = claimed_path
+            
+            if not in_flight:
+                # Sin trabajo: esperar una notificación, el próximo barrido o el próximo reintento
+                wake_at = min([next_scan] + list(retry_at.values()))
+                try:
+                    filepath = pending.get(timeout=max(0.1, wake_at - time.time()))
+                    # Se reclama en la próxima vuelta
+                    pending.put(filepath)
+                except queue.Empty:
+                    pass
+                continue
+            
+            done, _ = wait(list(in_flight), timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                claimed_path = in_flight.pop(future)
+                try:
+                    total_inserted += future.result()
+                except BrokenProcessPool:
+                    in_flight[future] = claimed_path
+                    raise
+                except Exception as e:
+                    logger.error(f"Error procesando archivo {claimed_path}: {e}")
+                # Si el archivo sigue reclamado hubo un error: reintentarlo con espera, hasta INGEST_MAX_ATTEMPTS
+                if os.path.exists(claimed_path):
+                    if schedule_retry(claimed_path, attempts, retry_at):
+                        claimed.append(claimed_path)
+                else:
+                    attempts.pop(claimed_path, None)
+            
+            if done and not in_flight and not claimed and pending.empty():
                 if total_inserted > 0:
                     logger.info(f"Total de {total_inserted} eventos insertados en este ciclo")
+                total_inserted = 0
                     
                 # Verificar cantidad total de eventos
                 current_count = check_event_count(collection)
@@ -144,15 +1188,23 @@ def main():
                 # Si no hay suficientes eventos, podríamos generar alertas o incrementar la frecuencia de scraping
                 if current_count < 1000:
                     logger.warning(f"Solo hay {current_count} eventos en la base de datos, se necesitan al menos 10,000")
-            else:
-                logger.info("No se encontraron nuevos archivos para procesar")
-                
-            # Esperar antes del próximo ciclo
-            time.sleep(60)
             
+        except BrokenProcessPool as e:
+            # Un proceso del pool murió: reintentar sus archivos con un pool nuevo
+            logger.error(f"Pool de ingesta caído, reiniciando: {e}")
+            # Los archivos en curso cuentan un intento: uno que tumba el proceso no se reintenta sin fin
+            crashed = [path for path in in_flight.values() if os.path.exists(path)]
+            claimed = [path for path in crashed if schedule_retry(path, attempts, retry_at)] + \
+                      [path for path in claimed if os.path.exists(path)]
+            in_flight = {}
+            pool = new_ingest_pool()
         except Exception as e:
             logger.error(f"Error en ciclo principal: {e}")
             time.sleep(30)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:] == ["rebuild-rollups"]:
+        db, _ = initialize_db(get_mongo_client())
+        rebuild_rollups(db)
+    else:
+        main()
\ No newline at end of file
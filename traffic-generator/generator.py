@@ -9,11 +9,18 @@ from bson.objectid import ObjectId
 import datetime
 import threading
 import redis
+import os
+import sys
+import socket
+import bisect
+import multiprocessing
 
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging compartido (common/logsetup.py, copiado junto a generator.py en la imagen)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from logsetup import setup_logging, log_request
+
+setup_logging()
 logger = logging.getLogger('traffic_generator')
 
 # Configuración de la caché
@@ -33,10 +40,68 @@ DISTRIBUTION_PARAMS = {
     }
 }
 
+# Configuración de ejecución distribuida
+# GENERATOR_ROLE: "coordinator" coordina y lanza GENERATOR_WORKERS procesos locales,
+# "worker" solo genera consultas (para correr workers en contenedores separados)
+GENERATOR_ROLE = os.environ.get("GENERATOR_ROLE", "coordinator")
+GENERATOR_WORKERS = int(os.environ.get("GENERATOR_WORKERS", "1"))
+# Tasa objetivo total en consultas/seg, repartida entre los workers (0 = intervalos por defecto)
+TARGET_RATE = float(os.environ.get("TARGET_RATE", "0"))
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+DISTRIBUTIONS = ["normal", "zipf"]
+DISTRIBUTION_SWITCH_INTERVAL = 600  # Cambio de distribución cada 10 minutos
+STATS_PUBLISH_INTERVAL = 5  # Cada cuánto publica un worker sus estadísticas
+REPORT_INTERVAL = 60  # Cada cuánto el coordinador imprime el reporte combinado
+EVENT_IDS_REFRESH = 60  # Cada cuánto se recarga la lista de UUIDs desde MongoDB
+
+# Canales y claves de Redis para la coordinación
+CONTROL_CHANNEL = "generator:control"
+STATS_CHANNEL = "generator:stats"
+CONFIG_KEY = "generator:config"
+
+# Límites superiores (ms) de los buckets del histograma de latencia
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def new_histogram():
+    """Crea un histograma de latencia vacío (un bucket extra para valores fuera de rango)"""
+    return [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+def record_latency(histogram, elapsed_ms):
+    """Registra una latencia en el bucket correspondiente"""
+    histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+def merge_histograms(histograms):
+    """Suma varios histogramas bucket a bucket"""
+    merged = new_histogram()
+    for histogram in histograms:
+        for i, count in enumerate(histogram):
+            merged[i] += count
+    return merged
+
+def histogram_percentile(histogram, percentile):
+    """Estima un percentil como el límite superior del bucket que lo contiene"""
+    total = sum(histogram)
+    if total == 0:
+        return 0
+    threshold = total * percentile / 100
+    accumulated = 0
+    for i, count in enumerate(histogram):
+        accumulated += count
+        if accumulated >= threshold:
+            return LATENCY_BUCKETS_MS[min(i, len(LATENCY_BUCKETS_MS) - 1)]
+    return LATENCY_BUCKETS_MS[-1]
+
+
+def new_distribution_stats():
+    return {"queries": 0, "hits": 0, "misses": 0, "errors": 0, "response_time_sum": 0,
+            "latency_hist": new_histogram()}
+
 # Variables para estadísticas
 stats = {
-    "normal": {"queries": 0, "hits": 0, "misses": 0, "errors": 0, "response_time_sum": 0},
-    "zipf": {"queries": 0, "hits": 0, "misses": 0, "errors": 0, "response_time_sum": 0},
+    "normal": new_distribution_stats(),
+    "zipf": new_distribution_stats(),
     "total_queries": 0,
     "start_time": time.time()
 }
@@ -44,6 +109,12 @@ stats = {
 # Configuración de Redis
 redis_client = redis.Redis(host='redis', port=6379, db=0)
 
+# Sesión HTTP con keep-alive (se crea por proceso en run_worker)
+http_session = None
+
+# Lista de UUIDs cargada desde MongoDB, se recarga cada EVENT_IDS_REFRESH segundos
+event_ids_cache = {"ids": [], "loaded_at": 0}
+
 
 def get_mongo_client():
     """Establece conexión con MongoDB con reintentos"""
@@ -67,12 +138,22 @@ def get_mongo_client():
     logger.critical("Falló la conexión a MongoDB después de múltiples intentos")
     raise Exception("No se pudo establecer conexión con MongoDB")
 
+def get_event_ids(collection):
+    """Devuelve la lista de UUIDs de Waze, recargándola periódicamente desde MongoDB"""
+    now = time.time()
+    if not event_ids_cache["ids"] or now - event_ids_cache["loaded_at"] >= EVENT_IDS_REFRESH:
+        event_ids_cache["ids"] = [
+            e["uuid"] for e in collection.find({"uuid": {"$regex": "^waze_"}}, {"uuid": 1, "_id": 0})
+        ]
+        event_ids_cache["loaded_at"] = now
+    return event_ids_cache["ids"]
+
 def get_normal_event_id(collection, mean=5, std_dev=2):
     """
     Obtiene un ID de evento usando una distribución Normal truncada.
     Simula que algunos eventos son más populares (cercanos al centro de la lista).
     """
-    all_events = list(collection.find({"uuid": {"$regex": "^waze_"}}, {"uuid": 1, "_id": 0}))
+    all_events = get_event_ids(collection)
     n = len(all_events)
     if n == 0:
         logger.warning("No hay eventos en la base de datos para Normal")
@@ -83,13 +164,13 @@ def get_normal_event_id(collection, mean=5, std_dev=2):
         idx = int(np.random.normal(loc=center, scale=n//6))  
         if 0 <= idx < n:
             break
-    event = all_events[idx]
-    logger.info(f"Seleccionado evento (Normal) con UUID: {event['uuid']}")
-    return event["uuid"]
+    event_id = all_events[idx]
+    log_request(logger, "Seleccionado evento (Normal)", event_id=event_id)
+    return event_id
 
 def get_zipf_event_id(collection, s=1.5):
     """Obtiene un ID de evento usando distribución de Zipf"""
-    all_events = list(collection.find({"uuid": {"$regex": "^waze_"}}, {"uuid": 1, "_id": 0}))
+    all_events = get_event_ids(collection)
     n = len(all_events)
     if n == 0:
         logger.warning("No hay eventos en la base de datos para Zipf")
@@ -99,15 +180,15 @@ def get_zipf_event_id(collection, s=1.5):
         idx = np.random.zipf(s) - 1 
         if idx < n:
             break
-    event = all_events[idx]
-    logger.info(f"Seleccionado evento (Zipf) con UUID: {event['uuid']}")
-    return event["uuid"]
+    event_id = all_events[idx]
+    log_request(logger, "Seleccionado evento (Zipf)", event_id=event_id)
+    return event_id
 
-def normal_distribution(mean, std_dev):
+def normal_distribution(mean, std_dev, minimum=0.1):
     """Genera intervalos de tiempo siguiendo distribución Normal"""
     # Tiempo entre llegadas sigue una distribución normal
     interval = np.random.normal(mean, std_dev)
-    return max(0.1, interval)  
+    return max(minimum, interval)
 
 def get_random_ttl(min_ttl=60, max_ttl=900):
     """
@@ -125,16 +206,17 @@ def send_query(event_id, distribution_type):
         # Generar un TTL aleatorio para cada consulta
         ttl = get_random_ttl()
         url = f"{CACHE_URL}?id={event_id}&distribution={distribution_type}&ttl={ttl}"
-        logger.info(f"Enviando consulta: {url} (TTL={ttl}s)")
+        log_request(logger, "Enviando consulta", url=url, ttl=ttl)
         
         start_time = time.time()
-        response = requests.get(url)
+        response = (http_session or requests).get(url)
         elapsed = time.time() - start_time
         
         # Actualizar estadísticas
         stats[distribution_type]["queries"] += 1
         stats["total_queries"] += 1
         stats[distribution_type]["response_time_sum"] += elapsed
+        record_latency(stats[distribution_type]["latency_hist"], elapsed * 1000)
         
         if response.status_code == 200:
             data = response.json()
@@ -143,8 +225,10 @@ def send_query(event_id, distribution_type):
             # Actualizar hit/miss en las estadísticas
             if source == "cache":
                 stats[distribution_type]["hits"] += 1
+            elif source == "database":
+                stats[distribution_type]["misses"] += 1
             
-            logger.info(f"Respuesta recibida desde {source} en {elapsed:.3f}s para {event_id}")
+            log_request(logger, "Respuesta recibida", source=source, elapsed=round(elapsed, 4), event_id=event_id)
             return True
         else:
             stats[distribution_type]["errors"] += 1
@@ -155,118 +239,275 @@ def send_query(event_id, distribution_type):
         logger.error(f"Error en consulta: {e}")
         return False
 
-def generate_traffic(distribution_type, collection):
-    """Genera tráfico según la distribución especificada"""
-    logger.debug(f"Generando tráfico con distribución {distribution_type}")
+def next_interval(distribution_type, rate=0):
+    """
+    Calcula el tiempo hasta la próxima consulta según la distribución.
+    Si se indica una tasa (consultas/seg del worker), el intervalo medio es 1/rate.
+    """
     if distribution_type == "normal":
         params = DISTRIBUTION_PARAMS["normal"]
-        interval = normal_distribution(params["mean"], params["std_dev"])
-        event_id = get_normal_event_id(collection, params["mean"], params["std_dev"])
+        if rate > 0:
+            mean = 1.0 / rate
+            return normal_distribution(mean, mean * params["std_dev"] / params["mean"], minimum=0)
+        return normal_distribution(params["mean"], params["std_dev"])
     elif distribution_type == "zipf":
-        interval = 0.1 #poner1
-        event_id = get_zipf_event_id(collection)
-    else:
-        logger.error(f"Distribución desconocida: {distribution_type}")
-        return False
+        return 1.0 / rate if rate > 0 else 0.1 #poner1
+    return None
+
+def pick_event_id(distribution_type, collection):
+    """Selecciona el ID a consultar según la distribución"""
+    if distribution_type == "normal":
+        params = DISTRIBUTION_PARAMS["normal"]
+        return get_normal_event_id(collection, params["mean"], params["std_dev"])
+    elif distribution_type == "zipf":
+        return get_zipf_event_id(collection)
+    return None
 
-    logger.debug(f"Intervalo generado: {interval:.2f} segundos")
-    time.sleep(interval)
-    if event_id:
-        return send_query(event_id, distribution_type)
-    return False
+def stats_snapshot(worker_id):
+    """Copia serializable de las estadísticas acumuladas del worker"""
+    return {
+        "worker_id": worker_id,
+        "timestamp": time.time(),
+        "start_time": stats["start_time"],
+        "distributions": {
+            dist: dict(stats[dist], latency_hist=list(stats[dist]["latency_hist"]))
+            for dist in DISTRIBUTIONS
+        }
+    }
 
-def print_stats_periodically():
-    """Imprime estadísticas periódicamente en un hilo separado"""
+def publish_stats_periodically(worker_id):
+    """Publica las estadísticas acumuladas del worker para que el coordinador las combine"""
     while True:
-        time.sleep(60)  # Cada minuto
+        time.sleep(STATS_PUBLISH_INTERVAL)
+        try:
+            redis_client.publish(STATS_CHANNEL, json.dumps(stats_snapshot(worker_id)))
+        except Exception as e:
+            logger.error(f"Error publicando estadísticas: {e}")
         
-        elapsed = time.time() - stats["start_time"]
-        total_queries = stats["total_queries"]
+def listen_for_control(worker_state):
+    """Aplica las configuraciones (distribución y tasa) que difunde el coordinador"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CONTROL_CHANNEL)
+            for message in pubsub.listen():
+                apply_config(worker_state, message["data"])
+        except Exception as e:
+            logger.error(f"Error en canal de control: {e}")
+            time.sleep(5)
         
-        if total_queries == 0:
-            continue
+def apply_config(worker_state, raw_config):
+    """Actualiza el estado del worker a partir de una configuración serializada"""
+    try:
+        config = json.loads(raw_config)
+    except (TypeError, ValueError):
+        logger.warning(f"Configuración inválida recibida: {raw_config}")
+        return
+    if config.get("distribution") in DISTRIBUTIONS and config["distribution"] != worker_state["distribution"]:
+        logger.info(f"Cambiando a distribución {config['distribution']}")
+    worker_state["distribution"] = config.get("distribution", worker_state["distribution"])
+    worker_state["rate"] = config.get("worker_rate", worker_state["rate"])
             
-        rate = total_queries / elapsed
-        
-        # Estadísticas por distribución
-        for dist in ["normal", "zipf"]:
-            if stats[dist]["queries"] > 0:
-                hit_rate = (stats[dist]["hits"] / stats[dist]["queries"]) * 100
-                avg_time = stats[dist]["response_time_sum"] / stats[dist]["queries"] * 1000
-                
-                logger.info(f"Distribución {dist.upper()}: {stats[dist]['queries']} consultas, "
-                            f"Hit rate: {hit_rate:.2f}%, "
-                            f"Tiempo medio: {avg_time:.2f}ms")
-        
-        # Estadísticas globales
-        logger.info(f"Total: {total_queries} consultas generadas, "
-                    f"Tasa promedio: {rate:.2f} consultas/seg, "
-                    f"Tiempo total: {elapsed:.1f} segundos")
-
-
-def main():
-    """Función principal del generador de tráfico"""
-    logger.info("Iniciando servicio generador de tráfico")
-    
-    # Esperar a que los otros servicios estén disponibles
-    time.sleep(30)
+def run_worker(worker_id=None):
+    """Genera consultas con la distribución y tasa indicadas por el coordinador"""
+    global http_session
+    worker_id = worker_id or WORKER_ID
+    logger.info(f"Iniciando worker {worker_id}")
+    http_session = requests.Session()
     
     # Conectar a MongoDB
     client = get_mongo_client()
-    db = client['traffic_db']
-    global collection
-    collection = db['traffic_events']
-    global current_distribution
+    collection = client['traffic_db']['traffic_events']
     
     # Esperar a que haya datos en la base
     while collection.count_documents({}) < 10:
         logger.warning("No hay suficientes datos en la base, esperando...")
         time.sleep(60)
     
-    logger.info(f"Base de datos tiene {collection.count_documents({})} eventos")
+    # Estado inicial: la última configuración difundida por el coordinador, si existe
+    worker_state = {"distribution": DISTRIBUTIONS[0], "rate": 0}
+    current_config = redis_client.get(CONFIG_KEY)
+    if current_config:
+        apply_config(worker_state, current_config)
     
-    # Variables para alternar entre distribuciones
-    distribuciones = ["normal", "zipf"]
+    threading.Thread(target=listen_for_control, args=(worker_state,), daemon=True).start()
+    threading.Thread(target=publish_stats_periodically, args=(worker_id,), daemon=True).start()
+
+    next_send = time.time()
+    while True:
+        try:
+            distribution = worker_state["distribution"]
+            interval = next_interval(distribution, worker_state["rate"])
+            if interval is None:
+                logger.error(f"Distribución desconocida: {distribution}")
+                time.sleep(5)
+                continue
+
+            # Programar la consulta respecto al envío anterior para sostener la tasa
+            next_send += interval
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1:
+                # Muy atrasado: no acumular una ráfaga de consultas pendientes
+                next_send = time.time()
+
+            send_query(pick_event_id(distribution, collection), distribution)
+        except Exception as e:
+            logger.error(f"Error en el generador de tráfico: {e}")
+            time.sleep(5)
+            next_send = time.time()
+
+def broadcast_config(distribution, active_workers):
+    """Difunde la distribución actual y la tasa que le corresponde a cada worker"""
+    worker_rate = TARGET_RATE / max(1, active_workers) if TARGET_RATE > 0 else 0
+    config = {
+        "distribution": distribution,
+        "worker_rate": worker_rate,
+        "target_rate": TARGET_RATE,
+        "workers": active_workers,
+        "updated_at": time.time()
+    }
+    payload = json.dumps(config)
+    redis_client.set(CONFIG_KEY, payload)
+    # Se mantiene la clave que lee /stats del servicio de caché
+    redis_client.set("current_distribution", distribution)
+    redis_client.publish(CONTROL_CHANNEL, payload)
+    logger.info(f"Configuración difundida: distribución {distribution}, "
+                f"{active_workers} workers, {worker_rate:.2f} consultas/seg por worker")
+
+def collect_worker_stats(worker_snapshots, lock):
+    """Recibe las estadísticas publicadas por los workers"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(STATS_CHANNEL)
+            for message in pubsub.listen():
+                snapshot = json.loads(message["data"])
+                snapshot["received_at"] = time.time()
+                with lock:
+                    worker_snapshots[snapshot["worker_id"]] = snapshot
+        except Exception as e:
+            logger.error(f"Error recibiendo estadísticas de workers: {e}")
+            time.sleep(5)
+
+def merge_worker_stats(snapshots):
+    """Combina las estadísticas acumuladas de todos los workers en un reporte"""
+    report = {"workers": len(snapshots), "total_queries": 0, "distributions": {}}
+    if not snapshots:
+        return report
+
+    start_time = min(s["start_time"] for s in snapshots)
+    for dist in DISTRIBUTIONS:
+        per_worker = [s["distributions"][dist] for s in snapshots if dist in s["distributions"]]
+        merged = {key: sum(w[key] for w in per_worker)
+                  for key in ["queries", "hits", "misses", "errors", "response_time_sum"]}
+        histogram = merge_histograms(w["latency_hist"] for w in per_worker)
+        merged["hit_rate"] = (merged["hits"] / merged["queries"] * 100) if merged["queries"] else 0
+        merged["avg_ms"] = (merged["response_time_sum"] / merged["queries"] * 1000) if merged["queries"] else 0
+        for p in [50, 95, 99]:
+            merged[f"p{p}_ms"] = histogram_percentile(histogram, p)
+        report["distributions"][dist] = merged
+        report["total_queries"] += merged["queries"]
+
+    report["elapsed"] = time.time() - start_time
+    report["rate"] = report["total_queries"] / report["elapsed"] if report["elapsed"] > 0 else 0
+    return report
+
+def log_report(report, active_workers):
+    """Imprime el reporte combinado"""
+    if report["total_queries"] == 0:
+        return
+
+    # Estadísticas por distribución
+    for dist, merged in report["distributions"].items():
+        if merged["queries"] > 0:
+            logger.info(f"Distribución {dist.upper()}: {merged['queries']} consultas, "
+                        f"Hit rate: {merged['hit_rate']:.2f}%, "
+                        f"Tiempo medio: {merged['avg_ms']:.2f}ms, "
+                        f"p50/p95/p99: {merged['p50_ms']}/{merged['p95_ms']}/{merged['p99_ms']}ms, "
+                        f"Errores: {merged['errors']}")
+
+    # Estadísticas globales
+    logger.info(f"Total: {report['total_queries']} consultas generadas por "
+                f"{active_workers}/{report['workers']} workers activos, "
+                f"Tasa promedio: {report['rate']:.2f} consultas/seg, "
+                f"Tiempo total: {report['elapsed']:.1f} segundos")
+
+def run_coordinator():
+    """Reparte la tasa objetivo, difunde los cambios de distribución y combina estadísticas"""
+    logger.info(f"Iniciando coordinador con {GENERATOR_WORKERS} workers locales")
+
+    # Lanzar los workers locales (con 0, los workers corren en otros contenedores)
+    processes = {}
+    for i in range(GENERATOR_WORKERS):
+        worker_id = f"{WORKER_ID}-w{i}"
+        processes[worker_id] = multiprocessing.Process(target=run_worker, args=(worker_id,), daemon=True)
+        processes[worker_id].start()
+
+    worker_snapshots = {}
+    lock = threading.Lock()
+    threading.Thread(target=collect_worker_stats, args=(worker_snapshots, lock), daemon=True).start()
+
     idx = 0
-    
-    # Iniciar hilo para imprimir estadísticas periódicamente
-    stats_thread = threading.Thread(target=print_stats_periodically, daemon=True)
-    stats_thread.start()
-    
-    # Generar tráfico continuamente
-    query_count = 0
-    start_time = time.time()
-    current_distribution = redis_client.get("current_distribution")
-    if current_distribution:
-        current_distribution = current_distribution.decode()
-    else:
-        current_distribution = "unknown"
+    current_distribution = DISTRIBUTIONS[idx]
+    active_workers = max(1, GENERATOR_WORKERS)
+    broadcast_config(current_distribution, active_workers)
+    distribution_switch_time = time.time() + DISTRIBUTION_SWITCH_INTERVAL
+    next_report_time = time.time() + REPORT_INTERVAL
     
     while True:
         try:
+            time.sleep(1)
+            now = time.time()
+
+            # Reiniciar workers locales que hayan terminado
+            for worker_id, process in list(processes.items()):
+                if not process.is_alive():
+                    logger.warning(f"Worker {worker_id} terminó (código {process.exitcode}), reiniciando")
+                    processes[worker_id] = multiprocessing.Process(target=run_worker, args=(worker_id,), daemon=True)
+                    processes[worker_id].start()
+
+            with lock:
+                snapshots = list(worker_snapshots.values())
+            alive = [s for s in snapshots if now - s["received_at"] < 3 * STATS_PUBLISH_INTERVAL]
+
             # Verificar si es momento de cambiar la distribución
-            if time.time() >= distribution_switch_time:
-                idx = (idx + 1) % len(distribuciones)
-                current_distribution = distribuciones[idx]
-                logger.info(f"Cambiando a distribución {current_distribution}")
-                distribution_switch_time = time.time() + 600  
+            changed = False
+            if now >= distribution_switch_time:
+                idx = (idx + 1) % len(DISTRIBUTIONS)
+                current_distribution = DISTRIBUTIONS[idx]
+                distribution_switch_time = now + DISTRIBUTION_SWITCH_INTERVAL
+                changed = True
                 
-                # Actualizar la distribución actual en Redis
-                redis_client.set("current_distribution", current_distribution)
+            # Repartir de nuevo la tasa si cambió el número de workers activos
+            if alive and len(alive) != active_workers:
+                active_workers = len(alive)
+                changed = True
             
-            # Generar una consulta
-            if generate_traffic(current_distribution, collection):
-                query_count += 1
+            if changed:
+                broadcast_config(current_distribution, active_workers)
             
-            # Registrar estadísticas cada 100 consultas
-            if query_count % 100 == 0 and query_count > 0:
-                elapsed = time.time() - start_time
-                rate = query_count / elapsed
-                logger.info(f"Estadísticas: {query_count} consultas generadas, tasa promedio: {rate:.2f} consultas/seg")
+            if now >= next_report_time:
+                next_report_time = now + REPORT_INTERVAL
+                log_report(merge_worker_stats(snapshots), len(alive))
                 
         except Exception as e:
-            logger.error(f"Error en el generador de tráfico: {e}")
+            logger.error(f"Error en el coordinador: {e}")
             time.sleep(5) 
 
+
+def main():
+    """Función principal del generador de tráfico"""
+    logger.info(f"Iniciando servicio generador de tráfico (rol: {GENERATOR_ROLE})")
+
+    # Esperar a que los otros servicios estén disponibles
+    time.sleep(30)
+
+    if GENERATOR_ROLE == "worker":
+        run_worker()
+    else:
+        run_coordinator()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file